@@ -1,25 +1,27 @@
 import argparse
 
+def assign_chains(all_chain_list, designed_chain_list):
+    fixed_chain_list = [letter for letter in all_chain_list if letter not in designed_chain_list] #fix/do not redesign these chains 
+    return (designed_chain_list, fixed_chain_list)
+
 def main(args):
     import json
+    from parsed_jsonl import ParsedJSONL
 
-    with open(args.input_path, 'r') as json_file:
-        json_list = list(json_file)
+    parsed_pdbs = ParsedJSONL(args.input_path)
     
     global_designed_chain_list = []
     if args.chain_list != '':
         global_designed_chain_list = [str(item) for item in args.chain_list.split()]
     my_dict = {}
-    for json_str in json_list:
-        result = json.loads(json_str)
-        all_chain_list = [item[-1:] for item in list(result) if item[:9]=='seq_chain'] #['A','B', 'C',...]
+    for name, seqs in parsed_pdbs:
+        all_chain_list = list(seqs) #['A','B', 'C',...]
         if len(global_designed_chain_list) > 0:
             designed_chain_list = global_designed_chain_list
         else:
             #manually specify, e.g.
             designed_chain_list = ["A"]
-        fixed_chain_list = [letter for letter in all_chain_list if letter not in designed_chain_list] #fix/do not redesign these chains 
-        my_dict[result['name']]= (designed_chain_list, fixed_chain_list)
+        my_dict[name]= assign_chains(all_chain_list, designed_chain_list)
     
     with open(args.output_path, 'w') as f:
         f.write(json.dumps(my_dict) + '\n')
@@ -0,0 +1,119 @@
+# Picks the MPNN designs worth folding and writes them as one fasta for ESMFold.
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, List
+
+import numpy as np
+import numpy.typing as npt
+
+from sort_by_score import ScoreTable, dedup_order, load_score_table, read_score_table, sort_order
+
+
+def expand_fasta_paths(paths: Iterable[Path]) -> List[Path]:
+    """Replaces folders (e.g. the MPNN "seqs" output folder) by the fasta files in them."""
+    fasta_paths = []
+    for path in paths:
+        if path.is_dir():
+            fasta_paths.extend(sorted(el for el in path.iterdir() if el.suffix in (".fa", ".fasta")))
+        else:
+            fasta_paths.append(path)
+    return fasta_paths
+
+
+def top_k_per_source(table: ScoreTable, order: npt.NDArray[np.int64], k: int) -> npt.NDArray[np.int64]:
+    """Keeps the first k rows of every source in a ranked row order, grouped by source (best first)."""
+    sources, codes = np.unique(table.columns["source"][order], return_inverse=True)
+    grouped = np.argsort(codes, kind="stable")
+    starts = np.searchsorted(codes[grouped], np.arange(len(sources)))
+    rank = np.arange(len(grouped)) - starts[codes[grouped]]
+    return order[grouped[rank < k]]
+
+
+def esmfold_name(source: str, sample: float, tag: str = "") -> str:
+    """Name in the format the ESMFold scripts expect, i.e. "{target}__sample_{n}" (the native being sample 0).
+
+    A tag (e.g. "T0.1") is added to the target part, so the name still ends in "__sample_{n}".
+    """
+    source = re.sub(r"[^A-Za-z0-9._-]", "_", f"{source}_{tag}" if tag else source).replace(".", "-")
+    return f"{source}__sample_{0 if np.isnan(sample) else int(sample)}"
+
+
+def esmfold_names(table: ScoreTable, rows: npt.NDArray[np.int64]) -> List[str]:
+    """Unique ESMFold names for the rows.
+
+    MPNN numbers the samples of every run from 1, so runs of the same target (e.g. at two temperatures) repeat
+    "{target}__sample_{n}". Repeated names get the sampling temperature, and a running index if they still clash.
+    """
+    sources = table.columns["source"][rows].tolist()
+    samples = table.columns["sample"][rows].tolist()
+    names = [esmfold_name(source, sample) for source, sample in zip(sources, samples)]
+    repeated = {name for name, count in Counter(names).items() if count > 1}
+    if "T" in table.columns:
+        temperatures = table.columns["T"][rows].tolist()
+        names = [
+            esmfold_name(source, sample, f"T{temperature:g}") if name in repeated and not np.isnan(temperature) else name
+            for name, source, sample, temperature in zip(names, sources, samples, temperatures)
+        ]
+
+    counts = Counter(names)
+    seen: Counter = Counter()
+    unique = []
+    for name, source, sample in zip(names, sources, samples):
+        if counts[name] > 1:
+            seen[name] += 1
+            name = esmfold_name(name.rsplit("__sample_", 1)[0], sample, f"dup{seen[name]}")
+        unique.append(name)
+    return unique
+
+
+def esmfold_sequence(sequence: str) -> str:
+    """MPNN separates chains with "/", ESMFold uses ":" for multimers."""
+    return sequence.replace("/", ":")
+
+
+def build_queue(table: ScoreTable, top_k: int, sort_by: List[str], include_native: bool = False) -> npt.NDArray[np.int64]:
+    """Returns the rows to fold: unique sequences only, then the top_k best of every source structure."""
+    order = sort_order(table, sort_by)
+    if not include_native:
+        order = order[~np.isnan(table.columns["sample"][order])]
+
+    # Duplicates are dropped over all inputs first, so every target gets top_k distinct sequences.
+    order = dedup_order(table, order)
+    return top_k_per_source(table, order, top_k)
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Select the top k MPNN designs per backbone as one fasta for ESMFold.")
+    parser.add_argument("fasta_paths", type=Path, nargs="*", help="MPNN fasta outputs, or folders of them.")
+    parser.add_argument("-o", "--out_path", type=Path, default=Path("./esmfold_queue.fa"), help="Path to the ESMFold fasta.")
+    parser.add_argument("-k", "--top_k", type=int, default=10, help="Number of designs kept per source structure.")
+    parser.add_argument(
+        "-s", "--sort_by", nargs="+", default=["score"], help='Fields to rank on, see sort_by_score.py (e.g. "score").'
+    )
+    parser.add_argument("--include_native", action="store_true", help="Also fold the native sequences (as sample 0).")
+    parser.add_argument("--load_table", type=Path, default=None, help="Use a table saved by sort_by_score.py --save_table.")
+    args = parser.parse_args()
+
+    if args.load_table is not None:
+        table = load_score_table(args.load_table)
+    elif args.fasta_paths:
+        table = read_score_table(expand_fasta_paths(args.fasta_paths))
+    else:
+        parser.error("Either fasta_paths or --load_table is required.")
+
+    rows = build_queue(table, args.top_k, args.sort_by, args.include_native)
+    with open(args.out_path, "w") as f:
+        for name, sequence in zip(esmfold_names(table, rows), table.sequences[rows].tolist()):
+            f.write(f">{name}\n{esmfold_sequence(sequence)}\n")
+
+    print(
+        f"Kept {len(rows)} of {len(table.sequences)} sequences from {len(np.unique(table.columns['source'][rows]))} structures, "
+        f"written to {args.out_path}."
+    )
+
+
+if __name__ == "__main__":
+    main()
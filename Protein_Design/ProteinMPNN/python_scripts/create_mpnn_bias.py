@@ -3,9 +3,10 @@
 
 import json
 import logging
+import os
 import string
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, NamedTuple, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 import numpy as np
 import numpy.typing as npt
@@ -39,7 +40,7 @@ _3_TO_1 = {three: one for three, one in zip(_3_LETTER_CODES, _1_LETTER_CODES)}
 
 
 class ResidueBias(NamedTuple):
-    selection: Dict[str, npt.NDArray[np.bool_]]
+    selection: npt.NDArray[np.bool_]
     bias: npt.NDArray[np.floating]
 
 
@@ -73,6 +74,13 @@ select name GLY,ALA res A:10;
 
 # Select all non Cysteine residues and increase their bias to Cysteine by 220.5.
 select name !CYS res C:220.5;
+
+# Select residues whose CA is within 8 Angstrom of any CA of chain B (not chain B
+# itself), e.g. the interface, and bias them towards polar residues.
+select near B:8.0 res DEKR:1.5;
+
+# The target of "near" uses the same format as "idx", e.g. residues around a pocket.
+select near A45,A60-62:6.5 & name !GLY res FWY:1;
 """.strip()
 
 
@@ -97,9 +105,36 @@ def _to_one_letter_code(three_or_one: str) -> str:
     return _3_TO_1[three_or_one]
 
 
-def _parse_index_selection(index_selection: str, struct_dict: Dict[str, List[str]]) -> Dict[str, npt.NDArray[np.bool_]]:
+class EncodedStructure(NamedTuple):
+    chains: List[str]
+    offsets: npt.NDArray[np.int64]
+    seq: npt.NDArray[np.uint8]
+    ca: Optional[npt.NDArray[np.floating]] = None
+
+
+def encode_structure(
+    struct_dict: Dict[str, List[str]], ca_coords: Optional[Dict[str, npt.NDArray[np.floating]]] = None
+) -> EncodedStructure:
+    """Concatenates all chains into one uint8 residue code array, with the chain start offsets.
+
+    CA coordinates per chain (see `get_ca_coords`) are needed for "near" selections.
+    """
+    lookup = {code: i for i, code in enumerate(_1_LETTER_CODES)}
+    chains = [c.upper() for c in struct_dict]
+    offsets = np.cumsum([0] + [len(el) for el in struct_dict.values()])
+    seq = np.fromiter((lookup[res] for el in struct_dict.values() for res in el), dtype=np.uint8, count=offsets[-1])
+
+    ca = None
+    if ca_coords is not None:
+        ca = np.concatenate([ca_coords[c] for c in struct_dict]) if struct_dict else np.zeros((0, 3))
+        if len(ca) != len(seq):
+            raise ValueError(f"Got {len(ca)} CA coordinates for {len(seq)} residues.")
+    return EncodedStructure(chains, offsets, seq, ca)
+
+
+def _parse_index_selection(index_selection: str, struct: EncodedStructure) -> npt.NDArray[np.bool_]:
     selections = index_selection.split(",")
-    selected_res = {c.upper(): np.full((len(el),), False) for c, el in struct_dict.items()}
+    selected_res = np.zeros(len(struct.seq), dtype=bool)
 
     for s in selections:
         invert = False
@@ -107,76 +142,134 @@ def _parse_index_selection(index_selection: str, struct_dict: Dict[str, List[str
             invert = True
             s = s[1:]
 
-        chain: Iterable[str] = selected_res.keys()
+        chain: Iterable[int] = range(len(struct.chains))
         if s[0].upper() in string.ascii_uppercase:
-            chain = [s[0].upper()]
+            chain = [struct.chains.index(s[0].upper())]
             s = s[1:]
 
-        if "-" in s:
+        if not s:
+            # A chain on its own, e.g. "B", selects the whole chain.
+            start, end = 1, len(struct.seq)
+        elif "-" in s:
             start, end = tuple(int(el) for el in s.split("-"))
-            slice_ = slice(start - 1, end)
         else:
-            start = int(s)
-            slice_ = slice(start - 1, start)
+            start = end = int(s)
 
         for c in chain:
-            selected_res[c][slice_] = True
+            # Slices of the flat mask, clipped at both ends so they never run into a neighbouring chain
+            # (e.g. index 0 would otherwise select the last residue of the previous chain).
+            chain_start, chain_end = struct.offsets[c], struct.offsets[c + 1]
+            lo = min(max(chain_start + start - 1, chain_start), chain_end)
+            selected_res[lo : min(chain_start + end, chain_end)] = True
             if invert:
-                selected_res[c] = ~selected_res[c]
+                np.logical_not(selected_res[chain_start:chain_end], out=selected_res[chain_start:chain_end])
 
     return selected_res
 
 
-def _parse_resname_selection(
-    name_selection: str, struct_dict: Dict[str, List[str]]
-) -> Dict[str, npt.NDArray[np.bool_]]:
+def _parse_resname_selection(name_selection: str, struct: EncodedStructure) -> npt.NDArray[np.bool_]:
     # TODO update with chain selection
     invert = False
     if name_selection.startswith("!"):
         invert = True
         name_selection = name_selection[1:]
 
-    selected_res = {c.upper(): np.full((len(el),), False) for c, el in struct_dict.items()}
-    restypes = {_to_one_letter_code(el) for el in name_selection.split(",")}
-
-    for sele, chain in zip(selected_res.values(), struct_dict.values()):
-        for idx, res in enumerate(chain):
-            if res in restypes:
-                sele[idx] = True
+    restypes = [_1_LETTER_CODES.index(_to_one_letter_code(el)) for el in name_selection.split(",")]
+    selected_res = np.isin(struct.seq, restypes)
 
     if invert:
-        return {c: ~s for c, s in selected_res.items()}
+        return ~selected_res
     return selected_res
 
 
-def parse_command(command: str, struct_dict: Dict[str, List[str]]) -> ResidueBias:
-    """Parses a single command and returns a `ResidueBias` corresponding to this selection."""
+def _within_cutoff(
+    points: npt.NDArray[np.floating], targets: npt.NDArray[np.floating], cutoff: float
+) -> npt.NDArray[np.bool_]:
+    """Marks the points that have any target within `cutoff`, using a cell list instead of all pairwise distances.
+
+    Targets are binned into cubic cells of side `cutoff`, so only the 27 cells around each point need checking.
+    Points or targets with missing (NaN) coordinates never match.
+    """
+    import itertools
+
+    hit = np.zeros(len(points), dtype=bool)
+    valid = np.flatnonzero(~np.isnan(points).any(axis=1))
+    targets = targets[~np.isnan(targets).any(axis=1)]
+    if len(valid) == 0 or len(targets) == 0:
+        return hit
+
+    points = points[valid]
+    origin = np.minimum(points.min(axis=0), targets.min(axis=0))
+    point_cells = np.floor((points - origin) / cutoff).astype(np.int64) + 1
+    target_cells = np.floor((targets - origin) / cutoff).astype(np.int64) + 1
+    dims = np.maximum(point_cells.max(axis=0), target_cells.max(axis=0)) + 2
+
+    def cell_key(cells: npt.NDArray[np.int64]) -> npt.NDArray[np.int64]:
+        return (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+
+    target_keys = cell_key(target_cells)
+    order = np.argsort(target_keys, kind="stable")
+    target_keys = target_keys[order]
+
+    for shift in itertools.product((-1, 0, 1), repeat=3):
+        keys = cell_key(point_cells + np.array(shift))
+        lo = np.searchsorted(target_keys, keys, side="left")
+        counts = np.searchsorted(target_keys, keys, side="right") - lo
+        if not counts.any():
+            continue
+
+        # Expand to (point, target) candidate pairs sharing this neighbouring cell.
+        point_idx = np.repeat(np.arange(len(points)), counts)
+        target_idx = order[np.arange(counts.sum()) + np.repeat(lo - (np.cumsum(counts) - counts), counts)]
+        close = ((points[point_idx] - targets[target_idx]) ** 2).sum(axis=1) <= cutoff**2
+        hit[valid[point_idx[close]]] = True
+
+    return hit
+
+
+def _parse_near_selection(near_selection: str, struct: EncodedStructure) -> npt.NDArray[np.bool_]:
+    if ":" not in near_selection:
+        raise ValueError(f'Improperly formatted near selection "{near_selection}", should be e.g. "B:8.0".')
+    if struct.ca is None:
+        raise ValueError('"near" selections need the CA coordinates from the parsed structure JSON.')
+
+    target, cutoff = near_selection.rsplit(":", 1)
+    target_res = _parse_index_selection(target, struct)
+    return _within_cutoff(struct.ca, struct.ca[target_res], float(cutoff)) & ~target_res
+
+
+def parse_command(command: str, struct_dict: Union[Dict[str, List[str]], EncodedStructure]) -> ResidueBias:
+    """Parses a single command and returns a `ResidueBias` corresponding to this selection.
+
+    Selections are boolean masks over all residues of the structure, chains concatenated in order.
+    Pass an `EncodedStructure` to avoid re-encoding the structure for every command.
+    """
     _res_selections = {
         "idx": _parse_index_selection,
         "name": _parse_resname_selection,
+        "near": _parse_near_selection,
     }
+    struct = struct_dict if isinstance(struct_dict, EncodedStructure) else encode_structure(struct_dict)
 
     cmd, *tokens, bias_kw, restypes = command.split()
     if cmd != "select":
         raise KeyError(f'Invalid token "{cmd}" at beginning of command: "{command}"')
 
     # Determine selected residues.
-    selection = {c.upper(): np.full((len(el),), False) for c, el in struct_dict.items()}
+    for t in tokens[::3]:
+        if t not in _res_selections:
+            valid_tokens = '", "'.join(_res_selections)
+            raise KeyError(f'Invalid token "{t}" did you mean: "{valid_tokens}"')
     t, res = tokens[:2]
-    if t not in _res_selections:
-        valid_tokens = '", "'.join(_res_selections)
-        raise KeyError(f'Invalid token "{t}" did you mean: "{valid_tokens}"')
-    selection.update(_res_selections[t](res, struct_dict))
-
-    for logic_op, t, res in zip(tokens[::3], tokens[1::3], tokens[2::3]):
-        updated_selections = _res_selections[t](res, struct_dict)
-        for chain, sele in updated_selections.values():
-            if logic_op == "&" or logic_op == "and":
-                selection[chain] &= sele
-            elif logic_op == "|" or logic_op == "or":
-                selection[chain] |= sele
-            else:
-                raise KeyError(f'Unknown logical operator "{logic_op}".')
+    selection = _res_selections[t](res, struct)
+
+    for logic_op, t, res in zip(tokens[2::3], tokens[3::3], tokens[4::3]):
+        if logic_op == "&" or logic_op == "and":
+            selection &= _res_selections[t](res, struct)
+        elif logic_op == "|" or logic_op == "or":
+            selection |= _res_selections[t](res, struct)
+        else:
+            raise KeyError(f'Unknown logical operator "{logic_op}".')
 
     # Parse biases.
     if bias_kw != "res":
@@ -206,48 +299,200 @@ def parse_command_file(command_path: Path) -> List[str]:
     return list(filter(None, commands))
 
 
+def structure_from_sequences(seqs: Dict[str, str]) -> Dict[str, List[str]]:
+    """Converts chain sequences, keyed by chain (or "seq_chain_X"), to a structure dict."""
+    structure: Dict[str, List[str]] = {}
+    for chain, seq in seqs.items():
+        chain_id = chain[-1].upper()
+        if chain_id in structure:
+            raise KeyError(f'Duplicate chain "{chain_id}" found.')
+
+        structure[chain_id] = [_to_one_letter_code(el) for el in seq]
+
+    return structure
+
+
+def get_ca_coords(data: Dict[str, Any], struct_json_path: Optional[Path] = None) -> Dict[str, npt.NDArray[np.floating]]:
+    """Returns the (L, 3) CA coordinates of each chain of a parsed structure, keyed like `structure_from_sequences`."""
+    if "coords_sidecar" in data:
+        from parse_multiple_chains import materialize_coords
+
+        folder = Path(struct_json_path).resolve().parent if struct_json_path is not None else Path(".")
+        data = materialize_coords(dict(data), np.load(folder / data["coords_sidecar"], mmap_mode="r"))
+
+    ca_coords = {}
+    for key in data:
+        if not key.startswith("seq_chain_"):
+            continue
+
+        chain = key[len("seq_chain_") :]
+        ca = data[f"coords_chain_{chain}"][f"CA_chain_{chain}"]
+        ca_coords[chain[-1].upper()] = np.asarray(ca, dtype=float).reshape(-1, 3)
+
+    return ca_coords
+
+
+def load_structure(struct_json_path: Path, with_coords: bool = False) -> Tuple[EncodedStructure, str]:
+    """Reads a parsed structure json into an `EncodedStructure`, with CA coordinates if requested."""
+    structure, name = get_protein_sequence(struct_json_path)
+    ca_coords = None
+    if with_coords:
+        ca_coords = get_ca_coords(json.loads(Path(struct_json_path).read_text()), struct_json_path)
+    return encode_structure(structure, ca_coords), name
+
+
 def get_protein_sequence(struct_json_path: Path) -> Tuple[Dict[str, List[str]], str]:
     struct_json_path = Path(struct_json_path)
     data = json.loads(struct_json_path.read_text())
-    structure: Dict[str, List[str]] = {}
 
     name = data.get("name", None)
     if name is None:
         raise KeyError(f"Missing name in structure JSON file.")
 
-    for chain, seq in data.items():
-        if not chain.startswith("seq_"):
-            continue
+    structure = structure_from_sequences({k: v for k, v in data.items() if k.startswith("seq_")})
+    return structure, name
 
-        chain_id = chain[-1].upper()
-        if chain_id in structure:
-            raise KeyError(f'Duplicate chain "{chain_id}" found.')
 
-        structure[chain_id] = [_to_one_letter_code(el) for el in seq]
+def bias_matrices(
+    struct_dict: Union[Dict[str, List[str]], EncodedStructure], biases: List[ResidueBias]
+) -> Dict[str, npt.NDArray[np.floating]]:
+    """Applies the biases in order and returns the per-chain (L, 21) bias matrices."""
+    struct = struct_dict if isinstance(struct_dict, EncodedStructure) else encode_structure(struct_dict)
+    matrix = np.zeros((len(struct.seq), len(_1_LETTER_CODES)))
+    for b in biases:
+        # Only the non-zero biases overwrite earlier values of the selected residues.
+        non_zero = np.flatnonzero(b.bias)
+        matrix[np.ix_(np.flatnonzero(b.selection), non_zero)] = b.bias[non_zero]
 
-    return structure, name
+    return {c: matrix[start:end] for c, start, end in zip(struct.chains, struct.offsets[:-1], struct.offsets[1:])}
+
+
+def to_sparse(matrix: npt.NDArray[np.floating]) -> Dict[str, Any]:
+    """Keeps only the biased rows of a (L, 21) bias matrix: {"length": L, "rows": [...], "bias": [[...], ...]}."""
+    rows = np.flatnonzero(matrix.any(axis=1))
+    return {"length": len(matrix), "rows": rows.tolist(), "bias": matrix[rows].tolist()}
+
+
+def to_dense(chain_bias: Union[List[List[float]], Dict[str, Any]]) -> npt.NDArray[np.floating]:
+    """Returns the (L, 21) bias matrix of a chain, whether it was written dense or sparse."""
+    if not isinstance(chain_bias, dict):
+        return np.asarray(chain_bias, dtype=float)
+
+    matrix = np.zeros((chain_bias["length"], len(_1_LETTER_CODES)))
+    if chain_bias["rows"]:
+        matrix[chain_bias["rows"]] = chain_bias["bias"]
+    return matrix
+
+
+def load_bias_json(bias_path: Path) -> Dict[str, Dict[str, npt.NDArray[np.floating]]]:
+    """Loads a dense or sparse bias JSON as {name: {chain: (L, 21) bias matrix}}."""
+    data = json.loads(Path(bias_path).read_text())
+    return {name: {chain: to_dense(el) for chain, el in chains.items()} for name, chains in data.items()}
 
 
 def write_bias_json(
-    struct_dict: Dict[str, List[str]], biases: List[ResidueBias], name: str, out_path: Path, overwrite: bool = False
+    struct_dict: Union[Dict[str, List[str]], EncodedStructure],
+    biases: List[ResidueBias],
+    name: str,
+    out_path: Path,
+    overwrite: bool = False,
+    sparse: bool = False,
 ) -> None:
     out_path = Path(out_path)
     if out_path.exists() and not overwrite:
         raise FileExistsError(f'"{out_path}" already exists.')
 
-    json_out = {name: {k: np.zeros((len(v), len(_1_LETTER_CODES))) for k, v in struct_dict.items()}}
-    # json_out = {name: {k: np.zeros((len(_1_LETTER_CODES), len(v))) for k, v in struct_dict.items()}}
-    pdb = json_out[name]
-    for b in biases:
-        for chain, sele in b.selection.items():
-            bias = np.tile(b.bias, (sele.sum(), 1))
-            pdb[chain][sele] = np.where(b.bias != 0, bias, pdb[chain][sele])  # [non_zero]
-
-    for k in pdb:
-        pdb[k] = pdb[k].tolist()
+    pdb = bias_matrices(struct_dict, biases)
+    json_out = {name: {k: to_sparse(v) if sparse else v.tolist() for k, v in pdb.items()}}
     out_path.write_text(json.dumps(json_out))
 
 
+def expand_bias_json(bias_path: Path, out_path: Path, overwrite: bool = False) -> None:
+    """Rewrites a sparse bias JSON with the dense matrices that protein_mpnn_run.py reads."""
+    out_path = Path(out_path)
+    if out_path.exists() and not overwrite:
+        raise FileExistsError(f'"{out_path}" already exists.')
+
+    dense = load_bias_json(bias_path)
+    out_path.write_text(json.dumps({name: {k: v.tolist() for k, v in chains.items()} for name, chains in dense.items()}))
+
+
+def iter_structures(input_path: Path, with_coords: bool = False) -> Iterator[Tuple[EncodedStructure, str]]:
+    """Yields (structure, name) for a parsed structure json, a ".jsonl" of them or a directory of ".json" files.
+
+    Coordinates are only read when `with_coords` is set, i.e. when a command uses a "near" selection.
+    """
+    input_path = Path(input_path)
+    if input_path.is_dir():
+        for path in sorted(input_path.glob("*.json")):
+            yield load_structure(path, with_coords)
+    elif input_path.suffix == ".jsonl":
+        from parsed_jsonl import ParsedJSONL
+
+        parsed = ParsedJSONL(str(input_path))
+        for name, seqs in parsed:
+            ca_coords = get_ca_coords(parsed.entry(name)) if with_coords else None
+            yield encode_structure(structure_from_sequences(seqs), ca_coords), name
+    else:
+        yield load_structure(input_path, with_coords)
+
+
+def structure_bias(
+    structure_and_name: Tuple[Union[Dict[str, List[str]], EncodedStructure], str],
+    commands: List[str],
+    sparse: bool = False,
+) -> Tuple[str, Dict[str, Any]]:
+    """Applies all commands to one structure, returns its name and per-chain bias matrices as lists."""
+    structure, name = structure_and_name
+    struct = structure if isinstance(structure, EncodedStructure) else encode_structure(structure)
+    biases = [parse_command(cmd, struct) for cmd in commands]
+    return name, {k: to_sparse(v) if sparse else v.tolist() for k, v in bias_matrices(struct, biases).items()}
+
+
+def write_batch_bias_json(
+    structures: Iterable[Tuple[Union[Dict[str, List[str]], EncodedStructure], str]],
+    commands: List[str],
+    out_path: Path,
+    overwrite: bool = False,
+    workers: int = 1,
+    sparse: bool = False,
+) -> int:
+    """Writes one bias JSON keyed by structure name for all structures, returns the number written.
+
+    The dictionary is streamed to a .partial file one structure at a time, optionally computed over a process pool,
+    and renamed to out_path once complete.
+    """
+    import functools
+    import multiprocessing
+
+    out_path = Path(out_path)
+    if out_path.exists() and not overwrite:
+        raise FileExistsError(f'"{out_path}" already exists.')
+
+    compute = functools.partial(structure_bias, commands=commands, sparse=sparse)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    results = pool.imap(compute, structures, chunksize=4) if pool is not None else map(compute, structures)
+
+    n_written = 0
+    partial_path = out_path.with_name(out_path.name + ".partial")
+    try:
+        with partial_path.open("w") as f:
+            f.write("{")
+            for name, chains in results:
+                if n_written:
+                    f.write(", ")
+                f.write(f"{json.dumps(name)}: {json.dumps(chains)}")
+                n_written += 1
+            f.write("}\n")
+        os.replace(partial_path, out_path)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return n_written
+
+
 def main() -> None:
     import argparse
 
@@ -258,9 +503,9 @@ def main() -> None:
         "-j",
         "--input_json",
         type=Path,
-        required=True,
         help='Parsed structure json file. To generate one from a PDB use "parse_multiple_chains.py" '
-        'May also provide a directory, in which case all files with a ".json" extension will be parsed.',
+        'May also provide a directory, in which case all files with a ".json" extension will be parsed, '
+        'or a ".jsonl" with many parsed structures. Both write a single bias JSON keyed by structure name.',
     )
     argument_parser.add_argument(
         "-o",
@@ -283,6 +528,20 @@ def main() -> None:
         type=str,
         help="Selection string corresponding to given bias. Uses the same formatting as the bias file.",
     )
+    group.add_argument(
+        "-x",
+        "--expand_sparse",
+        type=Path,
+        help='Sparse bias JSON (written with "--sparse") to expand into the dense format read by MPNN.',
+    )
+    argument_parser.add_argument(
+        "-w", "--workers", type=int, default=1, help="Number of processes to use when biasing many structures."
+    )
+    argument_parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="Only write the biased residues of each chain. Expand with \"-x\" before passing to MPNN.",
+    )
     argument_parser.add_argument("-e", dest="example", action="store_true", help="Prints example bias file.")
     argument_parser.add_argument(
         "--overwrite", action="store_true", help="Whether to allow overwritting existing files."
@@ -297,6 +556,13 @@ def main() -> None:
         print(print_example())
         raise SystemExit()
 
+    if args.expand_sparse is not None:
+        expand_bias_json(args.expand_sparse, args.out_path, overwrite=args.overwrite)
+        return
+
+    if args.input_json is None:
+        argument_parser.error("the following arguments are required: -j/--input_json")
+
     commands = parse_command_file(args.bias_file) if args.bias_file is not None else []
     if args.bias_string:
         commands.extend([el.strip() for el in args.bias_string.split(";") if el])
@@ -305,10 +571,25 @@ def main() -> None:
     for cmd in commands:
         logging.info("  - " + cmd)
 
-    structure, name = get_protein_sequence(args.input_json)
-
-    biases = [parse_command(cmd, structure) for cmd in commands]
-    write_bias_json(structure, biases, name, out_path=args.out_path, overwrite=args.overwrite)
+    with_coords = any("near" in cmd.split() for cmd in commands)
+    if args.input_json.is_dir() or args.input_json.suffix == ".jsonl":
+        out_path = args.out_path / "biases.jsonl" if args.out_path.is_dir() else args.out_path
+        n_written = write_batch_bias_json(
+            iter_structures(args.input_json, with_coords),
+            commands,
+            out_path,
+            overwrite=args.overwrite,
+            workers=args.workers,
+            sparse=args.sparse,
+        )
+        logging.info(f'Wrote biases for {n_written} structures to "{out_path}".')
+        return
+
+    struct, name = load_structure(args.input_json, with_coords)
+    out_path = args.out_path / f"{name}_bias.json" if args.out_path.is_dir() else args.out_path
+
+    biases = [parse_command(cmd, struct) for cmd in commands]
+    write_bias_json(struct, biases, name, out_path=out_path, overwrite=args.overwrite, sparse=args.sparse)
 
 
 if __name__ == "__main__":
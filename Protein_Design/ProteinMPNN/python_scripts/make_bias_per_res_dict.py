@@ -1,46 +1,76 @@
 import argparse
 
-def main(args):
-    import glob
-    import random
+mpnn_alphabet = 'ACDEFGHIKLMNPQRSTVWYX'
+
+def parse_bias_rules(rules_path):
+    '''
+    input:  rules_path = text file with one rule per line: chain residues amino_acids value, e.g.
+            A 4,8,14-15,22 AQERK 2.0
+            residues are 1-based and may be ranges, '#' starts a comment
+    output: [(chain, residue indices (0-based), amino acid columns, value), ...] in file order
+    '''
     import numpy as np
-    import json
-    
-    mpnn_alphabet = 'ACDEFGHIKLMNPQRSTVWYX'
-    
-    mpnn_alphabet_dict = {'A': 0,'C': 1,'D': 2,'E': 3,'F': 4,'G': 5,'H': 6,'I': 7,'K': 8,'L': 9,'M': 10,'N': 11,'P': 12,'Q': 13,'R': 14,'S': 15,'T': 16,'V': 17,'W': 18,'Y': 19,'X': 20}
-     
-    with open(args.input_path, 'r') as json_file:
-        json_list = list(json_file)   
- 
-    my_dict = {}
-    for json_str in json_list:
-        result = json.loads(json_str)
-        all_chain_list = [item[-1:] for item in list(result) if item[:10]=='seq_chain_']
-        bias_by_res_dict = {}
-        for chain in all_chain_list:
-            chain_length = len(result[f'seq_chain_{chain}'])
-            bias_per_residue = np.zeros([chain_length, 21])
 
+    rules = []
+    with open(rules_path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            try:
+                chain, residue_list, amino_acids, value = line.split()
+                residues = []
+                for item in residue_list.split(','):
+                    start, _, end = item.partition('-')
+                    residues.extend(range(int(start), int(end or start)+1))
+                columns = [mpnn_alphabet.index(aa) for aa in amino_acids.upper()]
+                value = float(value)
+            except ValueError:
+                raise ValueError(f'Could not parse rule on line {line_number} of {rules_path}: "{line}"')
+            rules.append((chain, np.asarray(residues, dtype=np.int64)-1, np.asarray(columns, dtype=np.int64), value))
+    return rules
 
-            if chain == 'A':
-                residues = [3, 7, 13, 14, 21, 24, 25, 27, 31, 34, 35, 42, 49, 52, 53, 54, 57, 61, 64, 65, 72, 78, 79, 81, 82, 83, 84, 85, 88, 89, 93, 95, 99, 100, 106, 107] #surface no loops
-                amino_acids = [0, 13, 3, 14, 8] #[A,Q,E,R,K]
-                for res in residues:
-                    for aa in amino_acids:
-                        bias_per_residue[res, aa] = 2.0
+def bias_per_res(seqs, rules, cache=None):
+    '''
+    input:  seqs = {chain: sequence} of one structure
+            rules = output of parse_bias_rules
+            cache = dict reused across structures (optional)
+    output: {chain: L x 21 bias matrix as lists}
 
-            if chain == 'A':
-                residues = [25, 26, 27, 28, 29, 52, 53, 54, 55, 56, 57, 58, 59, 83, 84, 85, 86, 87] #loops
-                amino_acids = [0, 13, 3, 14, 8, 5, 15, 16, 2, 12] #[A,Q,E,R,K,G,S,T,D,P]
-                for res in residues:
-                    for aa in amino_acids:
-                        bias_per_residue[res, aa] = 2.0
+    Later rules overwrite earlier ones, residues past the end of a chain are ignored.
+    The matrix only depends on the chain and its length, so with a cache each
+    (chain, length) is built once for the whole .jsonl.
+    '''
+    import numpy as np
 
+    bias_by_res_dict = {}
+    for chain, seq in seqs.items():
+        key = (chain, len(seq))
+        if cache is not None and key in cache:
+            bias_by_res_dict[chain] = cache[key]
+            continue
+        bias_per_residue = np.zeros([len(seq), 21])
+        for rule_chain, residues, columns, value in rules:
+            if rule_chain != chain:
+                continue
+            residues = residues[(residues >= 0) & (residues < len(seq))]
+            bias_per_residue[np.ix_(residues, columns)] = value
+        bias_by_res_dict[chain] = bias_per_residue.tolist()
+        if cache is not None:
+            cache[key] = bias_by_res_dict[chain]
+    return bias_by_res_dict
 
+def main(args):
+    import json
+    from parsed_jsonl import ParsedJSONL
 
-            bias_by_res_dict[chain] = bias_per_residue.tolist()
-        my_dict[result['name']] = bias_by_res_dict
+    rules = parse_bias_rules(args.rules_path)
+    parsed_pdbs = ParsedJSONL(args.input_path)
+
+    cache = {}
+    my_dict = {}
+    for name, seqs in parsed_pdbs:
+        my_dict[name] = bias_per_res(seqs, rules, cache)
 
     with open(args.output_path, 'w') as f:
         f.write(json.dumps(my_dict) + '\n')
@@ -50,6 +80,7 @@ if __name__ == "__main__":
     argparser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     argparser.add_argument("--input_path", type=str, help="Path to the parsed PDBs")
     argparser.add_argument("--output_path", type=str, help="Path to the output dictionary")
+    argparser.add_argument("--rules_path", type=str, required=True, help="Path to the bias rules, see example_bias_per_res.txt")
 
     args = argparser.parse_args()
-    main(args) 
+    main(args)
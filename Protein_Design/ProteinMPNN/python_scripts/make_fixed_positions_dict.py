@@ -1,44 +1,42 @@
 import argparse
 
+def fixed_positions(seqs, global_designed_chain_list, fixed_list, specify_non_fixed=False):
+    import numpy as np
+
+    all_chain_list = list(seqs)
+    fixed_position_dict = {}
+    if not specify_non_fixed:
+        for i, chain in enumerate(global_designed_chain_list):
+            fixed_position_dict[chain] = fixed_list[i]
+        for chain in all_chain_list:
+            if chain not in global_designed_chain_list:       
+                fixed_position_dict[chain] = []
+    else:
+        for chain in all_chain_list:
+            seq_length = len(seqs[chain])
+            all_residue_list = (np.arange(seq_length)+1).tolist()
+            if chain not in global_designed_chain_list:
+                fixed_position_dict[chain] = all_residue_list
+            else:
+                idx = np.argwhere(np.array(global_designed_chain_list) == chain)[0][0]
+                fixed_position_dict[chain] = list(set(all_residue_list)-set(fixed_list[idx]))
+    return fixed_position_dict
+
 def main(args):
     import glob
     import random
-    import numpy as np
     import json
     import itertools
+    from parsed_jsonl import ParsedJSONL
     
-    with open(args.input_path, 'r') as json_file:
-        json_list = list(json_file)
+    parsed_pdbs = ParsedJSONL(args.input_path)
     
     fixed_list = [[int(item) for item in one.split()] for one in args.position_list.split(",")]
     global_designed_chain_list = [str(item) for item in args.chain_list.split()]
     my_dict = {}
     
-    if not args.specify_non_fixed:
-        for json_str in json_list:
-            result = json.loads(json_str)
-            all_chain_list = [item[-1:] for item in list(result) if item[:9]=='seq_chain']
-            fixed_position_dict = {}
-            for i, chain in enumerate(global_designed_chain_list):
-                fixed_position_dict[chain] = fixed_list[i]
-            for chain in all_chain_list:
-                if chain not in global_designed_chain_list:       
-                    fixed_position_dict[chain] = []
-            my_dict[result['name']] = fixed_position_dict
-    else:
-        for json_str in json_list:
-            result = json.loads(json_str)
-            all_chain_list = [item[-1:] for item in list(result) if item[:9]=='seq_chain']
-            fixed_position_dict = {}   
-            for chain in all_chain_list:
-                seq_length = len(result[f'seq_chain_{chain}'])
-                all_residue_list = (np.arange(seq_length)+1).tolist()
-                if chain not in global_designed_chain_list:
-                    fixed_position_dict[chain] = all_residue_list
-                else:
-                    idx = np.argwhere(np.array(global_designed_chain_list) == chain)[0][0]
-                    fixed_position_dict[chain] = list(set(all_residue_list)-set(fixed_list[idx]))
-            my_dict[result['name']] = fixed_position_dict
+    for name, seqs in parsed_pdbs:
+        my_dict[name] = fixed_positions(seqs, global_designed_chain_list, fixed_list, args.specify_non_fixed)
 
     with open(args.output_path, 'w') as f:
         f.write(json.dumps(my_dict) + '\n')
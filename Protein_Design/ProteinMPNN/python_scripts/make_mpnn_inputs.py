@@ -0,0 +1,78 @@
+import argparse
+
+def main(args):
+    import json
+    import os
+    from pathlib import Path
+    from parsed_jsonl import ParsedJSONL
+    from assign_fixed_chains import assign_chains
+    from make_fixed_positions_dict import fixed_positions
+    from make_tied_positions_dict import tied_positions
+    from create_mpnn_bias import encode_structure, get_ca_coords, parse_command_file, structure_bias, structure_from_sequences
+
+    with open(args.spec_path, 'r') as f:
+        spec = json.load(f)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    parsed_pdbs = ParsedJSONL(args.input_path)
+
+    global_designed_chain_list = [str(item) for item in spec.get('chain_list', 'A').split()]
+
+    fixed_spec = spec.get('fixed_positions')
+    if fixed_spec is not None:
+        fixed_list = [[int(item) for item in one.split()] for one in fixed_spec['position_list'].split(",")]
+
+    tied_spec = spec.get('tied_positions')
+    if tied_spec is not None:
+        homooligomer = tied_spec.get('homooligomer', 0)
+        tied_list, tied_chain_list = [], []
+        if homooligomer == 0:
+            tied_list = [[int(item) for item in one.split()] for one in tied_spec['position_list'].split(",")]
+            tied_chain_list = [str(item) for item in tied_spec['chain_list'].split()]
+
+    # the command file is read once, each command is then applied to every structure
+    bias_commands = spec.get('bias_by_res')
+    if isinstance(bias_commands, str):
+        bias_commands = parse_command_file(Path(bias_commands))
+    # coordinates are only read from the .jsonl for "near" selections
+    with_coords = any('near' in cmd.split() for cmd in bias_commands or [])
+
+    outputs = {'assigned_pdbs': {}}
+    if fixed_spec is not None:
+        outputs['fixed_pdbs'] = {}
+    if tied_spec is not None:
+        outputs['tied_pdbs'] = {}
+    if bias_commands:
+        outputs['bias_by_res'] = {}
+
+    for name, seqs in parsed_pdbs:
+        outputs['assigned_pdbs'][name] = assign_chains(list(seqs), global_designed_chain_list)
+        if fixed_spec is not None:
+            outputs['fixed_pdbs'][name] = fixed_positions(seqs, global_designed_chain_list, fixed_list, fixed_spec.get('specify_non_fixed', False))
+        if tied_spec is not None:
+            outputs['tied_pdbs'][name] = tied_positions(seqs, tied_chain_list, tied_list, homooligomer, tied_spec.get('compact', False))
+        if bias_commands:
+            ca_coords = get_ca_coords(parsed_pdbs.entry(name)) if with_coords else None
+            struct = encode_structure(structure_from_sequences(seqs), ca_coords)
+            outputs['bias_by_res'][name] = structure_bias((struct, name), bias_commands)[1]
+
+    if 'bias_AA' in spec:
+        outputs['bias_AA'] = spec['bias_AA']
+
+    for file_name, my_dict in outputs.items():
+        with open(os.path.join(args.output_dir, file_name + '.jsonl'), 'w') as f:
+            f.write(json.dumps(my_dict) + '\n')
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    argparser.add_argument("--input_path", type=str, help="Path to the parsed PDBs")
+    argparser.add_argument("--spec_path", type=str, help="Path to the design spec .json, see example_spec.json")
+    argparser.add_argument("--output_dir", type=str, help="Folder for assigned_pdbs.jsonl, fixed_pdbs.jsonl, tied_pdbs.jsonl, bias_AA.jsonl and bias_by_res.jsonl")
+
+    args = argparser.parse_args()
+    main(args)
+
+#Writes the same dictionaries as assign_fixed_chains.py, make_fixed_positions_dict.py,
+#make_tied_positions_dict.py, make_bias_AA.py and create_mpnn_bias.py in one pass, only
+#for the sections present in the spec (assigned_pdbs.jsonl is always written).
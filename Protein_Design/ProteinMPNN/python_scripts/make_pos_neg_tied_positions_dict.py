@@ -7,9 +7,10 @@ def main(args):
     import numpy as np
     import json
     import itertools
+    from parsed_jsonl import ParsedJSONL
+    from make_tied_positions_dict import compact_tied_positions, expand_tied_positions
     
-    with open(args.input_path, 'r') as json_file:
-        json_list = list(json_file)
+    parsed_pdbs = ParsedJSONL(args.input_path)
     
     homooligomeric_state = args.homooligomer
 
@@ -17,16 +18,15 @@ def main(args):
         tied_list = [[int(item) for item in one.split()] for one in args.position_list.split(",")]
         global_designed_chain_list = [str(item) for item in args.chain_list.split()]
         my_dict = {}
-        for json_str in json_list:
-            result = json.loads(json_str)
-            all_chain_list = sorted([item[-1:] for item in list(result) if item[:9]=='seq_chain']) #A, B, C, ...
+        for name, seqs in parsed_pdbs:
+            all_chain_list = sorted(seqs) #A, B, C, ...
             tied_positions_list = []
             for i, pos in enumerate(tied_list[0]):
                 temp_dict = {}
                 for j, chain in enumerate(global_designed_chain_list):
                     temp_dict[chain] = [tied_list[j][i]] #needs to be a list
                 tied_positions_list.append(temp_dict)
-            my_dict[result['name']] = tied_positions_list
+            my_dict[name] = tied_positions_list
     else:
         if args.pos_neg_chain_list:
             chain_list_input = [[str(item) for item in one.split()] for one in args.pos_neg_chain_list.split(",")]
@@ -35,21 +35,16 @@ def main(args):
             chain_betas_flat = [item for sublist in chain_betas_input for item in sublist]
             chain_betas_dict = dict(zip(chain_list_flat, chain_betas_flat))
         my_dict = {}
-        for json_str in json_list:
-            result = json.loads(json_str)
-            all_chain_list = sorted([item[-1:] for item in list(result) if item[:9]=='seq_chain']) #A, B, C, ...
-            tied_positions_list = []
-            chain_length = len(result[f"seq_chain_{all_chain_list[0]}"])
+        for name, seqs in parsed_pdbs:
+            all_chain_list = sorted(seqs) #A, B, C, ...
+            chain_length = len(seqs[all_chain_list[0]])
+            residues = np.arange(1, chain_length+1)
+            compact = []
             for chains in chain_list_input:
-                for i in range(1,chain_length+1):
-                    temp_dict = {}
-                    for j, chain in enumerate(chains):
-                        if args.pos_neg_chain_list and chain in chain_list_flat:
-                            temp_dict[chain] = [[i], [chain_betas_dict[chain]]]
-                        else: 
-                            temp_dict[chain] = [[i], [1.0]] #first list is for residue numbers, second list is for weights for the energy, +ive and -ive design
-                    tied_positions_list.append(temp_dict)
-            my_dict[result['name']] = tied_positions_list
+                #first list is for residue numbers, second list is for weights for the energy, +ive and -ive design
+                betas = [chain_betas_dict[chain] if args.pos_neg_chain_list and chain in chain_list_flat else 1.0 for chain in chains]
+                compact.extend(compact_tied_positions(chains, np.tile(residues, (len(chains), 1)), betas))
+            my_dict[name] = compact if args.compact else expand_tied_positions(compact)
  
     with open(args.output_path, 'w') as f:
         f.write(json.dumps(my_dict) + '\n')
@@ -63,6 +58,7 @@ if __name__ == "__main__":
     argparser.add_argument("--homooligomer", type=int, default=0, help="If 0 do not use, if 1 then design homooligomer")
     argparser.add_argument("--pos_neg_chain_list", type=str, default='', help="Chain lists to be tied together")
     argparser.add_argument("--pos_neg_chain_betas", type=str, default='', help="Chain beta list for the chain lists provided; 1.0 for the positive design, -0.1 or -0.5 for negative, 0.0 means do not use that chain info")
+    argparser.add_argument("--compact", action="store_true", default=False, help="Write chain sets + residue ranges + betas instead of one dict per residue; expand with make_tied_positions_dict.py --expand_path before running MPNN")
 
     args = argparser.parse_args()
     main(args)
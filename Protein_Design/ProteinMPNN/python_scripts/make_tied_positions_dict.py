@@ -1,5 +1,76 @@
 import argparse
 
+def compact_tied_positions(chains, positions, betas=None):
+    '''
+    input:  chains = tied chains, e.g. ['A', 'B']
+            positions = (chains, positions) residue numbers tied across the chains
+            betas = per-chain weights, as in make_pos_neg_tied_positions_dict.py (optional)
+    output: [{"chains": [...], "ranges": [[start, end], ...], "offsets": [...], "betas": [...]}]
+    
+    Runs of consecutive residues are stored as ranges on the first chain's numbering,
+    with a per-chain offset (left out when all zero), instead of one dict per residue.
+    '''
+    import numpy as np
+
+    positions = np.asarray(positions).reshape(len(chains), -1)
+    if positions.shape[1] == 0:
+        return []
+    offsets = positions - positions[0]
+    # a run ends wherever the first chain skips a residue or any chain's offset changes
+    breaks = np.flatnonzero((np.diff(positions[0]) != 1) | np.any(np.diff(offsets, axis=1) != 0, axis=0)) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [positions.shape[1]]]) - 1
+    compact = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        run_offsets = offsets[:, start].tolist()
+        if compact and compact[-1].get('offsets', [0]*len(chains)) == run_offsets:
+            compact[-1]['ranges'].append([int(positions[0, start]), int(positions[0, end])])
+            continue
+        block = {'chains': list(chains), 'ranges': [[int(positions[0, start]), int(positions[0, end])]]}
+        if any(run_offsets):
+            block['offsets'] = run_offsets
+        if betas is not None:
+            block['betas'] = list(betas)
+        compact.append(block)
+    return compact
+
+def expand_tied_positions(compact):
+    # compact blocks -> [{"A": [1], "B": [1]}, ...] (or {"A": [[1], [beta]], ...} with betas)
+    tied_positions_list = []
+    for block in compact:
+        chains = block['chains']
+        offsets = block.get('offsets')
+        betas = block.get('betas')
+        for start, end in block['ranges']:
+            residues = range(start, end+1)
+            if offsets is None and betas is None:
+                tied_positions_list.extend(dict.fromkeys(chains, [i]) for i in residues)
+            elif betas is None:
+                tied_positions_list.extend({chain: [i+off] for chain, off in zip(chains, offsets)} for i in residues)
+            else:
+                offsets_ = offsets or [0]*len(chains)
+                tied_positions_list.extend({chain: [[i+off], [beta]] for chain, off, beta in zip(chains, offsets_, betas)} for i in residues)
+    return tied_positions_list
+
+def tied_positions(seqs, global_designed_chain_list, tied_list, homooligomer=0, compact=False):
+    import numpy as np
+
+    if homooligomer == 0:
+        if compact:
+            return compact_tied_positions(global_designed_chain_list, [tied_list[j][:len(tied_list[0])] for j in range(len(global_designed_chain_list))])
+        tied_positions_list = []
+        for i, pos in enumerate(tied_list[0]):
+            temp_dict = {}
+            for j, chain in enumerate(global_designed_chain_list):
+                temp_dict[chain] = [tied_list[j][i]] #needs to be a list
+            tied_positions_list.append(temp_dict)
+        return tied_positions_list
+    all_chain_list = sorted(seqs) #A, B, C, ...
+    chain_length = len(seqs[all_chain_list[0]])
+    residues = np.arange(1, chain_length+1)
+    tied = compact_tied_positions(all_chain_list, np.tile(residues, (len(all_chain_list), 1)))
+    return tied if compact else expand_tied_positions(tied)
+
 def main(args):
 
     import glob
@@ -7,39 +78,26 @@ def main(args):
     import numpy as np
     import json
     import itertools
-    
-    with open(args.input_path, 'r') as json_file:
-        json_list = list(json_file)
+    from parsed_jsonl import ParsedJSONL
     
     homooligomeric_state = args.homooligomer
 
+    if args.expand_path:
+        # expand a file written with --compact into the format protein_mpnn_run.py reads
+        with open(args.expand_path, 'r') as f:
+            compact_dict = json.loads(f.read())
+        with open(args.output_path, 'w') as f:
+            f.write(json.dumps({name: expand_tied_positions(tied) for name, tied in compact_dict.items()}) + '\n')
+        return
+
+    tied_list, global_designed_chain_list = [], []
     if homooligomeric_state == 0:
         tied_list = [[int(item) for item in one.split()] for one in args.position_list.split(",")]
         global_designed_chain_list = [str(item) for item in args.chain_list.split()]
-        my_dict = {}
-        for json_str in json_list:
-            result = json.loads(json_str)
-            all_chain_list = sorted([item[-1:] for item in list(result) if item[:9]=='seq_chain']) #A, B, C, ...
-            tied_positions_list = []
-            for i, pos in enumerate(tied_list[0]):
-                temp_dict = {}
-                for j, chain in enumerate(global_designed_chain_list):
-                    temp_dict[chain] = [tied_list[j][i]] #needs to be a list
-                tied_positions_list.append(temp_dict)
-            my_dict[result['name']] = tied_positions_list
-    else:
-        my_dict = {}
-        for json_str in json_list:
-            result = json.loads(json_str)
-            all_chain_list = sorted([item[-1:] for item in list(result) if item[:9]=='seq_chain']) #A, B, C, ...
-            tied_positions_list = []
-            chain_length = len(result[f"seq_chain_{all_chain_list[0]}"])
-            for i in range(1,chain_length+1):
-                temp_dict = {}
-                for j, chain in enumerate(all_chain_list):
-                    temp_dict[chain] = [i] #needs to be a list
-                tied_positions_list.append(temp_dict)
-            my_dict[result['name']] = tied_positions_list
+    parsed_pdbs = ParsedJSONL(args.input_path)
+    my_dict = {}
+    for name, seqs in parsed_pdbs:
+        my_dict[name] = tied_positions(seqs, global_designed_chain_list, tied_list, homooligomeric_state, args.compact)
  
     with open(args.output_path, 'w') as f:
         f.write(json.dumps(my_dict) + '\n')
@@ -51,6 +109,8 @@ if __name__ == "__main__":
     argparser.add_argument("--chain_list", type=str, default='', help="List of the chains that need to be fixed")
     argparser.add_argument("--position_list", type=str, default='', help="Position lists, e.g. 11 12 14 18, 1 2 3 4 for first chain and the second chain")
     argparser.add_argument("--homooligomer", type=int, default=0, help="If 0 do not use, if 1 then design homooligomer")
+    argparser.add_argument("--compact", action="store_true", default=False, help="Write chain sets + residue ranges instead of one dict per residue; expand with --expand_path before running MPNN")
+    argparser.add_argument("--expand_path", type=str, default='', help="Path to a --compact tied positions file to expand into --output_path")
 
     args = argparser.parse_args()
     main(args)
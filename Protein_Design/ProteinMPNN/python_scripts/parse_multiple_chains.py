@@ -1,163 +1,539 @@
 import argparse
+import functools
+import glob
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import numpy as np
 
-def main(args):
+alpha_1 = list("ARNDCQEGHILKMFPSTWYV-")
+states = len(alpha_1)
+alpha_3 = ['ALA','ARG','ASN','ASP','CYS','GLN','GLU','GLY','HIS','ILE',
+           'LEU','LYS','MET','PHE','PRO','SER','THR','TRP','TYR','VAL','GAP']
 
-    import numpy as np
-    import os, time, gzip, json
-    import glob 
-    
-    folder_with_pdbs_path = args.input_path
-    save_path = args.output_path
-    ca_only = args.ca_only
-    
-    alpha_1 = list("ARNDCQEGHILKMFPSTWYV-")
-    states = len(alpha_1)
-    alpha_3 = ['ALA','ARG','ASN','ASP','CYS','GLN','GLU','GLY','HIS','ILE',
-               'LEU','LYS','MET','PHE','PRO','SER','THR','TRP','TYR','VAL','GAP']
-    
-    aa_1_N = {a:n for n,a in enumerate(alpha_1)}
-    aa_3_N = {a:n for n,a in enumerate(alpha_3)}
-    aa_N_1 = {n:a for n,a in enumerate(alpha_1)}
-    aa_1_3 = {a:b for a,b in zip(alpha_1,alpha_3)}
-    aa_3_1 = {b:a for a,b in zip(alpha_1,alpha_3)}
-    
-    def AA_to_N(x):
-      # ["ARND"] -> [[0,1,2,3]]
-      x = np.array(x);
-      if x.ndim == 0: x = x[None]
-      return [[aa_1_N.get(a, states-1) for a in y] for y in x]
-    
-    def N_to_AA(x):
-      # [[0,1,2,3]] -> ["ARND"]
-      x = np.array(x);
-      if x.ndim == 1: x = x[None]
-      return ["".join([aa_N_1.get(a,"-") for a in y]) for y in x]
-    
-    
-    def parse_PDB_biounits(x, atoms=['N','CA','C'], chain=None):
-      '''
-      input:  x = PDB filename
-              atoms = atoms to extract (optional)
-      output: (length, atoms, coords=(x,y,z)), sequence
-      '''
-      xyz,seq,min_resn,max_resn = {},{},1e6,-1e6
-      for line in open(x,"rb"):
-        line = line.decode("utf-8","ignore").rstrip()
-    
-        if line[:6] == "HETATM" and line[17:17+3] == "MSE":
-          line = line.replace("HETATM","ATOM  ")
-          line = line.replace("MSE","MET")
-    
-        if line[:4] == "ATOM":
-          ch = line[21:22]
-          if ch == chain or chain is None:
-            atom = line[12:12+4].strip()
-            resi = line[17:17+3]
-            resn = line[22:22+5].strip()
-            x,y,z = [float(line[i:(i+8)]) for i in [30,38,46]]
-    
-            if resn[-1].isalpha(): 
-                resa,resn = resn[-1],int(resn[:-1])-1
-            else: 
-                resa,resn = "",int(resn)-1
-    #         resn = int(resn)
-            if resn < min_resn: 
-                min_resn = resn
-            if resn > max_resn: 
-                max_resn = resn
-            if resn not in xyz: 
-                xyz[resn] = {}
-            if resa not in xyz[resn]: 
-                xyz[resn][resa] = {}
-            if resn not in seq: 
-                seq[resn] = {}
-            if resa not in seq[resn]: 
-                seq[resn][resa] = resi
-    
-            if atom not in xyz[resn][resa]:
-              xyz[resn][resa][atom] = np.array([x,y,z])
+aa_1_N = {a:n for n,a in enumerate(alpha_1)}
+aa_3_N = {a:n for n,a in enumerate(alpha_3)}
+aa_N_1 = {n:a for n,a in enumerate(alpha_1)}
+aa_1_3 = {a:b for a,b in zip(alpha_1,alpha_3)}
+aa_3_1 = {b:a for a,b in zip(alpha_1,alpha_3)}
+
+def AA_to_N(x):
+  # ["ARND"] -> [[0,1,2,3]]
+  x = np.array(x);
+  if x.ndim == 0: x = x[None]
+  return [[aa_1_N.get(a, states-1) for a in y] for y in x]
+
+def N_to_AA(x):
+  # [[0,1,2,3]] -> ["ARND"]
+  x = np.array(x);
+  if x.ndim == 1: x = x[None]
+  return ["".join([aa_N_1.get(a,"-") for a in y]) for y in x]
+
+
+def parse_PDB_biounits(x, atoms=['N','CA','C'], chain=None):
+  '''
+  input:  x = PDB filename
+          atoms = atoms to extract (optional)
+  output: (length, atoms, coords=(x,y,z)), sequence
+  '''
+  xyz,seq,min_resn,max_resn = {},{},1e6,-1e6
+  for line in open(x,"rb"):
+    line = line.decode("utf-8","ignore").rstrip()
+
+    if line[:6] == "HETATM" and line[17:17+3] == "MSE":
+      line = line.replace("HETATM","ATOM  ")
+      line = line.replace("MSE","MET")
+
+    if line[:4] == "ATOM":
+      ch = line[21:22]
+      if ch == chain or chain is None:
+        atom = line[12:12+4].strip()
+        resi = line[17:17+3]
+        resn = line[22:22+5].strip()
+        x,y,z = [float(line[i:(i+8)]) for i in [30,38,46]]
+
+        if resn[-1].isalpha(): 
+            resa,resn = resn[-1],int(resn[:-1])-1
+        else: 
+            resa,resn = "",int(resn)-1
+#         resn = int(resn)
+        if resn < min_resn: 
+            min_resn = resn
+        if resn > max_resn: 
+            max_resn = resn
+        if resn not in xyz: 
+            xyz[resn] = {}
+        if resa not in xyz[resn]: 
+            xyz[resn][resa] = {}
+        if resn not in seq: 
+            seq[resn] = {}
+        if resa not in seq[resn]: 
+            seq[resn][resa] = resi
+
+        if atom not in xyz[resn][resa]:
+          xyz[resn][resa][atom] = np.array([x,y,z])
+
+  # convert to numpy arrays, fill in missing values
+  seq_,xyz_ = [],[]
+  try:
+      for resn in range(min_resn,max_resn+1):
+        if resn in seq:
+          for k in sorted(seq[resn]): seq_.append(aa_3_N.get(seq[resn][k],20))
+        else: seq_.append(20)
+        if resn in xyz:
+          for k in sorted(xyz[resn]):
+            for atom in atoms:
+              if atom in xyz[resn][k]: xyz_.append(xyz[resn][k][atom])
+              else: xyz_.append(np.full(3,np.nan))
+        else:
+          for atom in atoms: xyz_.append(np.full(3,np.nan))
+      return np.array(xyz_).reshape(-1,len(atoms),3), N_to_AA(np.array(seq_))
+  except TypeError:
+      return 'no_chain', 'no_chain'
+
+
+def _fixed_columns(records, start, stop):
+  # (N, 80) byte matrix -> one fixed-width bytes field per record
+  return np.ascontiguousarray(records[:,start:stop]).view('S%d' % (stop-start)).ravel()
+
+
+def _insertion_codes(icode):
+  # uint8 insertion codes; anything but a letter means no insertion code (0)
+  icode = icode.copy()
+  icode[~(((icode >= ord('A')) & (icode <= ord('Z'))) | ((icode >= ord('a')) & (icode <= ord('z'))))] = 0
+  return icode
+
+
+def open_structure(x):
+  # .gz files are decompressed on the fly rather than to scratch first
+  if x.endswith('.gz'):
+    return gzip.open(x,'rb')
+  return open(x,'rb')
+
+
+def read_PDB_records(x):
+  '''
+  input:  x = PDB filename (optionally gzipped)
+  output: ATOM (and MSE HETATM) records as an (N, 80) uint8 array, one row per line
+  '''
+  lines = []
+  with open_structure(x) as f:
+    tail = b''
+    for block in iter(lambda: f.read(1 << 24), b''):
+      block = tail + block
+      cut = block.rfind(b'\n') + 1
+      lines.extend(re.findall(rb'^(?:ATOM|HETATM)[^\r\n]*', block[:cut], re.M))
+      tail = block[cut:]
+    lines.extend(re.findall(rb'^(?:ATOM|HETATM)[^\r\n]*', tail, re.M))
+  # the S80 array pads short lines with zeros so every column can be sliced in bulk
+  records = np.array(lines, dtype='S80').view(np.uint8).reshape(-1,80)
+  is_hetatm = records[:,0] == ord('H')
+  if is_hetatm.any():
+    is_mse = _fixed_columns(records,17,20) == b'MSE'
+    records = records[~is_hetatm | is_mse]
+  return records
+
+
+def backbone_from_records(chain, resn, icode, atom, resi, xyz, atoms=['N','CA','C'], chains=None):
+  '''
+  input:  chain, resn, icode, atom, resi = per-atom chain IDs, residue numbers,
+            insertion codes (uint8, 0 if none), atom names and residue names
+          xyz = (atoms, coords=(x,y,z)) coordinates
+          atoms = atoms to extract (optional)
+          chains = chain IDs to keep, in output order (optional)
+  output: {chain: ((length, atoms, coords=(x,y,z)), sequence)}
+  
+  Residues are ordered by number then insertion code, missing residue numbers
+  are filled with gaps and the first record of a repeated atom wins, as in
+  parse_PDB_biounits.
+  '''
+  present = np.unique(chain)
+  if chains is None:
+    order = sorted(present.tolist())
+  else:
+    present = set(present.tolist())
+    order = [ch for ch in chains if ch in present]
+  
+  parsed = {}
+  for ch in order:
+    rows = np.flatnonzero(chain == ch)
+    r = resn[rows].astype(np.int64)
+    key = r*256 + icode[rows]
+    keys, first = np.unique(key, return_index=True)
+    # residue numbers missing between the first and last residue become gaps
+    span = np.arange(r.min(), r.max()+1)
+    gaps = span[~np.isin(span, r)]*256
+    slots = np.union1d(keys, gaps)
+    slot_of_row = np.searchsorted(slots, key)
     
-      # convert to numpy arrays, fill in missing values
-      seq_,xyz_ = [],[]
-      try:
-          for resn in range(min_resn,max_resn+1):
-            if resn in seq:
-              for k in sorted(seq[resn]): seq_.append(aa_3_N.get(seq[resn][k],20))
-            else: seq_.append(20)
-            if resn in xyz:
-              for k in sorted(xyz[resn]):
-                for atom in atoms:
-                  if atom in xyz[resn][k]: xyz_.append(xyz[resn][k][atom])
-                  else: xyz_.append(np.full(3,np.nan))
-            else:
-              for atom in atoms: xyz_.append(np.full(3,np.nan))
-          return np.array(xyz_).reshape(-1,len(atoms),3), N_to_AA(np.array(seq_))
-      except TypeError:
-          return 'no_chain', 'no_chain'
+    seq_ = np.full(len(slots), 20)
+    names, inverse = np.unique(resi[rows][first], return_inverse=True)
+    codes = np.array([aa_3_N.get(n,20) for n in names.tolist()])
+    seq_[np.searchsorted(slots, keys)] = codes[inverse.ravel()]
     
+    xyz_ = np.full((len(slots),len(atoms),3), np.nan)
+    chain_atom = atom[rows]
+    for j, a in enumerate(atoms):
+      sel = np.flatnonzero(chain_atom == a)
+      filled, first_atom = np.unique(slot_of_row[sel], return_index=True)
+      xyz_[filled,j] = xyz[rows[sel[first_atom]]]
+    parsed[ch] = (xyz_, N_to_AA(seq_))
+  return parsed
+
+
+def parse_PDB_biounit_chains(x, atoms=['N','CA','C'], chains=None):
+  '''
+  input:  x = PDB filename
+          atoms = atoms to extract (optional)
+          chains = chain IDs to keep, in output order (optional)
+  output: {chain: ((length, atoms, coords=(x,y,z)), sequence)}
+  
+  Reads the file once and decodes the fixed-width ATOM columns of all records
+  at once with NumPy, instead of re-scanning the whole file for every chain ID
+  like parse_PDB_biounits.
+  '''
+  records = read_PDB_records(x)
+  if len(records) == 0:
+    return {}
+  chain = records[:,21].view('S1').astype('U1')
+  resn = _fixed_columns(records,22,26).astype(np.int64)-1
+  icode = _insertion_codes(records[:,26])
+  atom = np.char.strip(_fixed_columns(records,12,16)).astype('U4')
+  resi = _fixed_columns(records,17,20).astype('U3')
+  resi[records[:,0] == ord('H')] = 'MET'
+  xyz = np.stack([_fixed_columns(records,i,i+8).astype(np.float64) for i in [30,38,46]], axis=-1)
+  return backbone_from_records(chain, resn, icode, atom, resi, xyz, atoms=atoms, chains=chains)
+
+
+def read_mmCIF_atom_site(x):
+  '''
+  input:  x = mmCIF filename (optionally gzipped)
+  output: {atom_site field: list of values} for the ATOM (and MSE HETATM) rows
+  
+  Streams the file and only tokenises the rows of the atom_site loop, so large
+  assemblies beyond the PDB format's chain/atom limits can be read directly.
+  '''
+  wanted = ['group_PDB','label_atom_id','label_comp_id','label_asym_id','auth_asym_id',
+            'label_seq_id','auth_seq_id','pdbx_PDB_ins_code','Cartn_x','Cartn_y','Cartn_z']
+  fields, columns, rows = [], {}, None
+  with open_structure(x) as f:
+    for line in f:
+      line = line.decode("utf-8","ignore").strip()
+      if rows is None:
+        if line.startswith('_atom_site.'):
+          fields.append(line.split()[0][len('_atom_site.'):])
+          continue
+        if not fields:
+          continue
+        # the first line after the _atom_site.* headers is the first row of the loop
+        columns = {name: fields.index(name) for name in wanted if name in fields}
+        rows = {name: [] for name in columns}
+      if not line or line[0] in '#_' or line.startswith('loop_') or line.startswith('data_'):
+        break
+      if "'" in line or '"' in line:
+        tokens = [t.strip('\'"') for t in re.findall(r"'[^']*'|\"[^\"]*\"|\S+", line)]
+      else:
+        tokens = line.split()
+      if tokens[columns['group_PDB']] == 'HETATM' and tokens[columns['label_comp_id']] != 'MSE':
+        continue
+      for name, i in columns.items():
+        rows[name].append(tokens[i])
+  return rows or {}
+
+
+def parse_mmCIF_biounit_chains(x, atoms=['N','CA','C'], chains=None):
+  '''
+  input:  x = mmCIF filename (optionally gzipped)
+          atoms = atoms to extract (optional)
+          chains = chain IDs to keep, in output order (optional)
+  output: {chain: ((length, atoms, coords=(x,y,z)), sequence)}
+  
+  Uses the author chain IDs and residue numbers, so the output matches that of
+  the same structure in PDB format.
+  '''
+  rows = read_mmCIF_atom_site(x)
+  if not rows or not rows['group_PDB']:
+    return {}
+  resn = np.array(rows.get('auth_seq_id', rows.get('label_seq_id')))
+  keep = (resn != '.') & (resn != '?')
+  chain = np.array(rows.get('auth_asym_id', rows.get('label_asym_id')))[keep]
+  resn = resn[keep].astype(np.int64)-1
+  if 'pdbx_PDB_ins_code' in rows:
+    icode = _insertion_codes(np.array(rows['pdbx_PDB_ins_code'], dtype='S1')[keep].view(np.uint8))
+  else:
+    icode = np.zeros(len(resn), dtype=np.uint8)
+  atom = np.array(rows['label_atom_id'])[keep]
+  resi = np.array(rows['label_comp_id'])[keep]
+  resi[np.array(rows['group_PDB'])[keep] == 'HETATM'] = 'MET'
+  xyz = np.stack([np.array(rows[k])[keep].astype(np.float64) for k in ['Cartn_x','Cartn_y','Cartn_z']], axis=-1)
+  return backbone_from_records(chain, resn, icode, atom, resi, xyz, atoms=atoms, chains=chains)
+
+
+init_alphabet = ['A', 'B', 'C', 'D', 'E', 'F', 'G','H', 'I', 'J','K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T','U', 'V','W','X', 'Y', 'Z', 'a', 'b', 'c', 'd', 'e', 'f', 'g','h', 'i', 'j','k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't','u', 'v','w','x', 'y', 'z']
+extra_alphabet = [str(item) for item in list(np.arange(300))]
+chain_alphabet = init_alphabet + extra_alphabet
+
+
+structure_extensions = ['.pdb', '.pdb.gz', '.cif', '.cif.gz']
+
+
+def biounit_name(biounit):
+    # file name without the directory and structure extension, e.g. inputs/5TTA.cif.gz -> 5TTA
+    fi = biounit.rfind("/")
+    name = biounit[(fi+1):]
+    for ext in structure_extensions:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def parse_biounit(biounit, ca_only=False, coords_as_arrays=False):
+    '''
+    input:  biounit = PDB filename
+            ca_only = parse a backbone-only structure (optional)
+            coords_as_arrays = keep coordinates as numpy arrays instead of lists (optional)
+    output: parsed-PDB dictionary for the .jsonl (None if every chain ID is used up)
+    '''
+    to_out = (lambda a: a) if coords_as_arrays else (lambda a: a.tolist())
+    my_dict = {}
+    s = 0
+    concat_seq = ''
+    if ca_only:
+        sidechain_atoms = ['CA']
+    else:
+        sidechain_atoms = ['N', 'CA', 'C', 'O']
+    if biounit.endswith('.cif') or biounit.endswith('.cif.gz'):
+        parsed_chains = parse_mmCIF_biounit_chains(biounit, atoms=sidechain_atoms)
+        # mmCIF chain IDs can be longer than one character; keep the PDB order first
+        rank = {ch: i for i, ch in enumerate(chain_alphabet)}
+        parsed_chains = dict(sorted(parsed_chains.items(), key=lambda item: (rank.get(item[0], len(rank)), item[0])))
+    else:
+        parsed_chains = parse_PDB_biounit_chains(biounit, atoms=sidechain_atoms, chains=chain_alphabet)
+    for letter, (xyz, seq) in parsed_chains.items():
+        concat_seq += seq[0]
+        my_dict['seq_chain_'+letter]=seq[0]
+        coords_dict_chain = {}
+        if ca_only:
+            coords_dict_chain['CA_chain_'+letter]=to_out(xyz)
+        else:
+            coords_dict_chain['N_chain_' + letter] = to_out(xyz[:, 0, :])
+            coords_dict_chain['CA_chain_' + letter] = to_out(xyz[:, 1, :])
+            coords_dict_chain['C_chain_' + letter] = to_out(xyz[:, 2, :])
+            coords_dict_chain['O_chain_' + letter] = to_out(xyz[:, 3, :])
+        my_dict['coords_chain_'+letter]=coords_dict_chain
+        s += 1
+    my_dict['name']=biounit_name(biounit)
+    my_dict['num_of_chains'] = s
+    my_dict['seq'] = concat_seq
+    if s < len(chain_alphabet):
+        return my_dict
+    return None
+
+
+class ParseCache:
+    '''
+    On-disk cache of parsed entries keyed on the content hash of each PDB file.
     
+    cache_dir/manifest.json maps a PDB path to [size, mtime_ns, sha1] so unchanged
+    files are not even re-hashed, and cache_dir/<sha1>[_ca].json holds the parsed
+    entry (its name is taken from the file name on load).
+    '''
+    def __init__(self, cache_dir, ca_only=False):
+        self.cache_dir = cache_dir
+        self.suffix = '_ca.json' if ca_only else '.json'
+        os.makedirs(cache_dir, exist_ok=True)
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.manifest = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+
+    def digest(self, biounit):
+        st = os.stat(biounit)
+        key = os.path.abspath(biounit)
+        known = self.manifest.get(key)
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        h = hashlib.sha1()
+        with open(biounit, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        self.manifest[key] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+    def _entry_path(self, digest):
+        return os.path.join(self.cache_dir, digest + self.suffix)
+
+    def has(self, digest):
+        return os.path.isfile(self._entry_path(digest))
+
+    def load(self, digest, biounit):
+        with open(self._entry_path(digest), 'r') as f:
+            entry = json.load(f)
+        if entry is not None:
+            entry['name'] = biounit_name(biounit)
+        return entry
+
+    def store(self, digest, entry):
+        path = self._entry_path(digest)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(entry, f, default=lambda a: a.tolist())
+        os.replace(path + '.tmp', path)
+
+    def save_manifest(self):
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+
+class CoordsSidecarWriter:
+    '''
+    Writes backbone coordinates to a float32 .npy sidecar instead of the .jsonl.
     
-    pdb_dict_list = []
-    c = 0
+    Every coordinate list of an entry (e.g. coords_chain_A -> N_chain_A) is replaced
+    by {"offset": o, "shape": [...]} pointing into the flat sidecar array, and the
+    entry gets a "coords_sidecar" reference to the file, relative to the folder of
+    the .jsonl at jsonl_path. read_parsed_jsonl turns such entries back into the
+    usual dictionaries.
+    '''
+    def __init__(self, path, jsonl_path):
+        self.path = path
+        self.ref = os.path.relpath(os.path.abspath(path), os.path.dirname(os.path.abspath(jsonl_path)))
+        self.raw = open(path + '.raw', 'wb')
+        self.size = 0
+
+    def add(self, entry):
+        for key, coords_dict_chain in entry.items():
+            if not key.startswith('coords_chain_'):
+                continue
+            for coords_key, xyz in coords_dict_chain.items():
+                xyz = np.asarray(xyz, dtype='<f4')
+                coords_dict_chain[coords_key] = {'offset': self.size, 'shape': list(xyz.shape)}
+                self.raw.write(xyz.tobytes())
+                self.size += xyz.size
+        self.raw.flush()
+        entry['coords_sidecar'] = self.ref
+        return entry
+
+    def close(self):
+        self.raw.close()
+        header = {'descr': '<f4', 'fortran_order': False, 'shape': (self.size,)}
+        with open(self.path + '.partial', 'wb') as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            with open(self.path + '.raw', 'rb') as raw:
+                shutil.copyfileobj(raw, f, 1 << 24)
+        os.replace(self.path + '.partial', self.path)
+        os.remove(self.path + '.raw')
+
+
+def materialize_coords(entry, coords):
+    '''
+    input:  entry = parsed-PDB dictionary written with a coordinate sidecar
+            coords = the sidecar array, e.g. np.load(path, mmap_mode='r')
+    output: the same entry with coordinate lists, as written without a sidecar
+    '''
+    for key, coords_dict_chain in entry.items():
+        if not key.startswith('coords_chain_'):
+            continue
+        for coords_key, ref in coords_dict_chain.items():
+            if isinstance(ref, dict):
+                start = ref['offset']
+                stop = start + int(np.prod(ref['shape']))
+                coords_dict_chain[coords_key] = coords[start:stop].reshape(ref['shape']).astype(np.float64).tolist()
+    entry.pop('coords_sidecar', None)
+    return entry
+
+
+def read_parsed_jsonl(jsonl_path, materialize=True):
+    '''
+    input:  jsonl_path = .jsonl written by this script, with or without a sidecar
+            materialize = fill in coordinates from the sidecar (optional)
+    output: generator of parsed-PDB dictionaries
+    '''
+    sidecars = {}
+    folder = os.path.dirname(os.path.abspath(jsonl_path))
+    with open(jsonl_path, 'r') as f:
+        for line in f:
+            entry = json.loads(line)
+            sidecar = entry.get('coords_sidecar')
+            if materialize and sidecar is not None:
+                if sidecar not in sidecars:
+                    sidecars[sidecar] = np.load(os.path.join(folder, sidecar), mmap_mode='r')
+                materialize_coords(entry, sidecars[sidecar])
+            yield entry
+
+
+def main(args):
+
+    folder_with_pdbs_path = args.input_path
+    save_path = args.output_path
+    ca_only = args.ca_only
     
     if folder_with_pdbs_path[-1]!='/':
         folder_with_pdbs_path = folder_with_pdbs_path+'/'
     
+    # sorted so that reruns write the same file regardless of --workers
+    biounit_names = sorted(name for ext in structure_extensions for name in glob.glob(folder_with_pdbs_path+'*'+ext))
+    sidecar = CoordsSidecarWriter(args.coords_path, save_path) if args.coords_path else None
+    parse_fn = functools.partial(parse_biounit, ca_only=ca_only, coords_as_arrays=sidecar is not None)
+    
+    # only new or changed files are parsed; cached entries are merged back in order
+    cache = ParseCache(args.cache_dir, ca_only=ca_only) if args.cache_dir else None
+    digests = [cache.digest(biounit) for biounit in biounit_names] if cache else [None]*len(biounit_names)
+    cached = [cache is not None and cache.has(digest) for digest in digests]
+    to_parse = [biounit for biounit, hit in zip(biounit_names, cached) if not hit]
     
-    init_alphabet = ['A', 'B', 'C', 'D', 'E', 'F', 'G','H', 'I', 'J','K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T','U', 'V','W','X', 'Y', 'Z', 'a', 'b', 'c', 'd', 'e', 'f', 'g','h', 'i', 'j','k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't','u', 'v','w','x', 'y', 'z']
-    extra_alphabet = [str(item) for item in list(np.arange(300))]
-    chain_alphabet = init_alphabet + extra_alphabet
+    pool = None
+    if args.workers > 1 and len(to_parse) > 1:
+        pool = multiprocessing.Pool(args.workers)
+        # imap keeps input order while workers run ahead on the next files
+        chunksize = max(1, min(16, len(to_parse) // (4*args.workers)))
+        parsed = pool.imap(parse_fn, to_parse, chunksize=chunksize)
+    else:
+        parsed = map(parse_fn, to_parse)
     
-    biounit_names = glob.glob(folder_with_pdbs_path+'*.pdb')
-    for biounit in biounit_names:
-        my_dict = {}
-        s = 0
-        concat_seq = ''
-        concat_N = []
-        concat_CA = []
-        concat_C = []
-        concat_O = []
-        concat_mask = []
-        coords_dict = {}
-        for letter in chain_alphabet:
-            if ca_only:
-                sidechain_atoms = ['CA']
-            else:
-                sidechain_atoms = ['N', 'CA', 'C', 'O']
-            xyz, seq = parse_PDB_biounits(biounit, atoms=sidechain_atoms, chain=letter)
-            if type(xyz) != str:
-                concat_seq += seq[0]
-                my_dict['seq_chain_'+letter]=seq[0]
-                coords_dict_chain = {}
-                if ca_only:
-                    coords_dict_chain['CA_chain_'+letter]=xyz.tolist()
+    # entries are streamed to a .partial file as they are parsed, so memory stays
+    # flat and a crash keeps everything written so far; it is renamed when complete
+    partial_path = save_path + '.partial'
+    try:
+        with open(partial_path, 'w') as f:
+            for biounit, digest, hit in zip(biounit_names, digests, cached):
+                if hit:
+                    entry = cache.load(digest, biounit)
                 else:
-                    coords_dict_chain['N_chain_' + letter] = xyz[:, 0, :].tolist()
-                    coords_dict_chain['CA_chain_' + letter] = xyz[:, 1, :].tolist()
-                    coords_dict_chain['C_chain_' + letter] = xyz[:, 2, :].tolist()
-                    coords_dict_chain['O_chain_' + letter] = xyz[:, 3, :].tolist()
-                my_dict['coords_chain_'+letter]=coords_dict_chain
-                s += 1
-        fi = biounit.rfind("/")
-        my_dict['name']=biounit[(fi+1):-4]
-        my_dict['num_of_chains'] = s
-        my_dict['seq'] = concat_seq
-        if s < len(chain_alphabet):
-            pdb_dict_list.append(my_dict)
-            c+=1
-            
-            
-    with open(save_path, 'w') as f:
-        for entry in pdb_dict_list:
-            f.write(json.dumps(entry) + '\n')
+                    entry = next(parsed)
+                    if cache is not None:
+                        cache.store(digest, entry)
+                if entry is not None:
+                    if sidecar is not None:
+                        sidecar.add(entry)
+                    f.write(json.dumps(entry) + '\n')
+                    f.flush()
+            os.fsync(f.fileno())
+        if sidecar is not None:
+            sidecar.close()
+        os.replace(partial_path, save_path)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if cache is not None:
+            cache.save_manifest()
            
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    argparser.add_argument("--input_path", type=str, help="Path to a folder with pdb files, e.g. /home/my_pdbs/")
+    argparser.add_argument("--input_path", type=str, help="Path to a folder with pdb/cif files (optionally .gz), e.g. /home/my_pdbs/")
     argparser.add_argument("--output_path", type=str, help="Path where to save .jsonl dictionary of parsed pdbs")
     argparser.add_argument("--ca_only", action="store_true", default=False, help="parse a backbone-only structure (default: false)")
+    argparser.add_argument("--workers", type=int, default=1, help="Number of processes used to parse pdb files in parallel")
+    argparser.add_argument("--cache_dir", type=str, default='', help="Folder for cached parsed entries; on reruns only new or changed pdb files are parsed")
+    argparser.add_argument("--coords_path", type=str, default='', help="Write coordinates as float32 to this .npy file instead of as lists in the .jsonl")
 
     args = argparser.parse_args()
     main(args)
@@ -0,0 +1,91 @@
+import json
+import os
+import re
+
+_NAME = re.compile(rb'"name": ("(?:[^"\\]|\\.)*")')
+_SEQ_CHAIN = re.compile(rb'"seq_chain_((?:[^"\\]|\\.)*)": "([^"]*)"')
+
+
+class ParsedJSONL:
+    '''
+    Lazy reader for the .jsonl written by parse_multiple_chains.py.
+
+    The first time a file is opened it is scanned once for the byte offset, name
+    and seq_chain_* fields of every entry, and that index is saved next to it as
+    <input_path>.idx (rebuilt whenever the .jsonl changes). The helper scripts then
+    only read the small index, and coordinates are never decoded unless a whole
+    entry is asked for with entry(name).
+
+    e.g.
+    for name, seqs in ParsedJSONL('parsed_pdbs.jsonl'):
+        all_chain_list = list(seqs) #['A','B', 'C',...]
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.entries = self._load_index()
+        self.offsets = {name: (offset, length) for name, offset, length, _ in self.entries}
+
+    def _load_index(self):
+        st = os.stat(self.path)
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            if index['size'] == st.st_size and index['mtime_ns'] == st.st_mtime_ns:
+                return index['entries']
+        entries = self._build_index()
+        try:
+            with open(self.index_path + '.tmp', 'w') as f:
+                json.dump({'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'entries': entries}, f)
+            os.replace(self.index_path + '.tmp', self.index_path)
+        except OSError:
+            pass # read-only location, the index is just not kept
+        return entries
+
+    def _build_index(self):
+        entries = []
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                length = len(line)
+                if line.strip():
+                    match = _NAME.search(line)
+                    seqs = {json.loads(b'"' + ch + b'"'): seq.decode() for ch, seq in _SEQ_CHAIN.findall(line)}
+                    if match is None or not seqs:
+                        # written with other separators than json.dumps' defaults, decode the whole line
+                        entry = json.loads(line)
+                        name = entry['name']
+                        seqs = {key[len('seq_chain_'):]: seq for key, seq in entry.items() if key.startswith('seq_chain_')}
+                    else:
+                        name = json.loads(match.group(1))
+                    entries.append([name, offset, length, seqs])
+                offset += length
+        return entries
+
+    def __iter__(self):
+        # (name, {chain: sequence}) in file order
+        for name, _, _, seqs in self.entries:
+            yield name, seqs
+
+    def __len__(self):
+        return len(self.entries)
+
+    def names(self):
+        return [name for name, _, _, _ in self.entries]
+
+    def entry(self, name, materialize=True):
+        '''
+        input:  name = structure name
+                materialize = fill in coordinates from a sidecar .npy (optional)
+        output: the full parsed-PDB dictionary, read by seeking to its line
+        '''
+        offset, length = self.offsets[name]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            entry = json.loads(f.read(length))
+        if materialize and 'coords_sidecar' in entry:
+            import numpy as np
+            from parse_multiple_chains import materialize_coords
+            folder = os.path.dirname(os.path.abspath(self.path))
+            materialize_coords(entry, np.load(os.path.join(folder, entry['coords_sidecar']), mmap_mode='r'))
+        return entry
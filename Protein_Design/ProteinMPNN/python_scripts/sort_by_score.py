@@ -1,7 +1,20 @@
 # Simple script to sort MPNN output file by score.
 # author: Tim Neary, timdot10@gmail.com
+import hashlib
+import heapq
+import itertools
+import re
+import tempfile
 from pathlib import Path
-from typing import Any, Iterable, List, Union
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, TextIO, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+
+Record = Tuple[str, str]
+
+# key=value pairs, values may be lists containing commas, e.g. designed_chains=['A', 'B'].
+_FIELD = re.compile(r"(\w+)=(\[[^\]]*\]|[^,]*)")
 
 
 def _chunk_list(l: List, chunk_size: int) -> Iterable:
@@ -29,18 +42,247 @@ def sort_scores(fasta_paths: List[Path]) -> List[str]:
     return sorted(_chunk_list(lines, 2), key=lambda el: get_score(el[0]))
 
 
+def _record_score(record: Record) -> float:
+    return get_score(record[0])
+
+
+def iter_records(fasta_paths: Iterable[Path]) -> Iterator[Record]:
+    """Streams (description, sequence) pairs from the fasta files, pairing lines like `sort_scores`."""
+
+    def lines() -> Iterator[str]:
+        for path in fasta_paths:
+            with open(path) as f:
+                yield from (line.rstrip("\r\n") for line in f)
+
+    it = lines()
+    for description in it:
+        yield description, next(it, "")
+
+
+def top_scores(fasta_paths: Iterable[Path], n: int) -> List[Record]:
+    """Returns the n best (lowest) scoring records, only ever holding n records in memory."""
+    return heapq.nsmallest(n, iter_records(fasta_paths), key=_record_score)
+
+
+def _write_chunk(records: List[Record], folder: Path, idx: int) -> Path:
+    path = folder / f"chunk_{idx}.fasta"
+    with open(path, "w") as f:
+        f.writelines(f"{description}\n{sequence}\n" for description, sequence in records)
+    return path
+
+
+def _iter_chunk(f: TextIO) -> Iterator[Record]:
+    for description in f:
+        yield description.rstrip("\n"), next(f).rstrip("\n")
+
+
+def _merge_chunks(chunk_paths: List[Path]) -> Iterator[Record]:
+    files = [open(path) for path in chunk_paths]
+    try:
+        # heapq.merge is stable across its inputs, so ties keep their input order as with sorted().
+        yield from heapq.merge(*(_iter_chunk(f) for f in files), key=_record_score)
+    finally:
+        for f in files:
+            f.close()
+
+
+def external_sort_scores(
+    fasta_paths: Iterable[Path], chunk_size: int = 100_000, tmp_dir: Optional[Path] = None, max_open: int = 64
+) -> Iterator[Record]:
+    """Yields all records sorted by score, holding at most `chunk_size` records in memory.
+
+    Records are sorted in chunks that are spilled to `tmp_dir`, then lazily merged. With more than `max_open`
+    chunks, they are first merged in groups so no more than `max_open` files are open at once.
+    Gives the same order as `sort_scores`.
+    """
+    records = iter_records(fasta_paths)
+    first = sorted(itertools.islice(records, chunk_size), key=_record_score)
+    if len(first) < chunk_size:
+        # Everything fit in one chunk, no need to go to disk.
+        yield from first
+        return
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as folder:
+        folder = Path(folder)
+        chunk_paths = [_write_chunk(first, folder, 0)]
+        del first
+        while True:
+            chunk = sorted(itertools.islice(records, chunk_size), key=_record_score)
+            if not chunk:
+                break
+            chunk_paths.append(_write_chunk(chunk, folder, len(chunk_paths)))
+
+        n_written = len(chunk_paths)
+        while len(chunk_paths) > max_open:
+            merged = []
+            for idx in range(0, len(chunk_paths), max_open):
+                group = chunk_paths[idx : idx + max_open]
+                merged.append(_write_chunk(_merge_chunks(group), folder, n_written))
+                n_written += 1
+                for path in group:
+                    path.unlink()
+            chunk_paths = merged
+
+        yield from _merge_chunks(chunk_paths)
+
+
+def write_records(records: Iterable[Record], out_path: Path) -> None:
+    """Writes records as fasta lines, without a trailing newline like the in memory version."""
+    with open(out_path, "w") as f:
+        for idx, (description, sequence) in enumerate(records):
+            f.write(("\n" if idx else "") + f"{description}\n{sequence}")
+
+
+
+class ScoreTable(NamedTuple):
+    descriptions: npt.NDArray[np.str_]
+    sequences: npt.NDArray[np.str_]
+    columns: Dict[str, npt.NDArray[Any]]
+
+
+def parse_description(fasta_description: str) -> Dict[str, str]:
+    """Splits an MPNN fasta description into its key=value fields."""
+    return {key: value.strip() for key, value in _FIELD.findall(fasta_description)}
+
+
+def read_score_table(fasta_paths: Iterable[Path]) -> ScoreTable:
+    """Parses every description once into columns, numeric fields as float arrays (NaN when missing).
+
+    The "source" column holds the name of the input structure, i.e. of the last native sequence above the record
+    in the same file, or the file name (without suffix) for records above the first native sequence.
+    """
+    descriptions, sequences, sources, fields = [], [], [], []
+    for path in fasta_paths:
+        source = Path(path).stem
+        for description, sequence in iter_records([path]):
+            first = description[1:].split(",", 1)[0].strip()
+            if "=" not in first:
+                source = first
+            descriptions.append(description)
+            sequences.append(sequence)
+            sources.append(source)
+            fields.append(parse_description(description))
+
+    columns: Dict[str, npt.NDArray[Any]] = {"source": np.array(sources, dtype=str)}
+    for key in dict.fromkeys(key for el in fields for key in el):
+        values = [el.get(key) for el in fields]
+        try:
+            columns[key] = np.array([np.nan if el is None else float(el) for el in values])
+        except ValueError:
+            columns[key] = np.array(["" if el is None else el for el in values], dtype=str)
+
+    return ScoreTable(np.array(descriptions, dtype=str), np.array(sequences, dtype=str), columns)
+
+
+def save_score_table(table: ScoreTable, path: Path) -> None:
+    """Saves a parsed table as .npz, so re-ranking doesn't need the fasta files again."""
+    columns = {f"column_{key}": value for key, value in table.columns.items()}
+    with open(path, "wb") as f:
+        np.savez(f, descriptions=table.descriptions, sequences=table.sequences, **columns)
+
+
+def load_score_table(path: Path) -> ScoreTable:
+    with np.load(path) as data:
+        columns = {key[len("column_") :]: data[key] for key in data.files if key.startswith("column_")}
+        return ScoreTable(data["descriptions"], data["sequences"], columns)
+
+
+def sort_order(table: ScoreTable, keys: List[str]) -> npt.NDArray[np.int64]:
+    """Returns the row order sorted on the given columns, the first key being the primary one.
+
+    Add ":desc" to a key to sort it in descending order. Ties keep their input order and missing values go last.
+    """
+    sort_keys = []
+    for key in keys:
+        key, _, direction = key.partition(":")
+        if direction not in ("", "asc", "desc"):
+            raise ValueError(f'Unknown sort direction "{direction}", should be "asc" or "desc".')
+        descending = direction == "desc"
+        if key not in table.columns:
+            raise KeyError(f'Unknown field "{key}", available fields are: {", ".join(table.columns)}.')
+
+        column = table.columns[key]
+        if column.dtype.kind != "f":
+            # Sort strings by their rank, so they can be reversed like numbers.
+            column = np.unique(column, return_inverse=True)[1].astype(float)
+        sort_keys.append(-column if descending else column)
+
+    # np.lexsort sorts on the last key first.
+    return np.lexsort(sort_keys[::-1]) if sort_keys else np.arange(len(table.sequences))
+
+
+def sequence_hashes(sequences: npt.NDArray[np.str_]) -> npt.NDArray[np.uint64]:
+    """64 bit hash of every sequence."""
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(el.encode(), digest_size=8).digest(), "little") for el in sequences),
+        dtype=np.uint64,
+        count=len(sequences),
+    )
+
+
+def dedup_order(table: ScoreTable, order: npt.NDArray[np.int64]) -> npt.NDArray[np.int64]:
+    """Drops repeated sequences from a row order, keeping the first (i.e. best ranked) copy."""
+    hashes = sequence_hashes(table.sequences)[order]
+    _, first = np.unique(hashes, return_index=True)
+    return order[np.sort(first)]
+
 
 def main() -> None:
     import argparse
 
     parser = argparse.ArgumentParser(description="Simple script to sort MPNN output file by score.")
-    parser.add_argument("fasta_paths", type=Path, nargs="+", help="Path to MPNN fasta output.")
+    parser.add_argument("fasta_paths", type=Path, nargs="*", help="Path to MPNN fasta output.")
     parser.add_argument("-o", "--out_path", type=Path, default=Path("./sorted.fasta"), help="Path to output of sorted scores.")
+    parser.add_argument("-n", "--top", type=int, default=None, help="Only keep the N best scoring sequences.")
+    parser.add_argument(
+        "-c",
+        "--chunk_size",
+        type=int,
+        default=100_000,
+        help="Number of sequences sorted in memory at once, larger inputs are merged from sorted chunks on disk.",
+    )
+    parser.add_argument(
+        "-k",
+        "--sort_by",
+        nargs="+",
+        default=None,
+        help='Fields to sort on, e.g. "score" or "seq_recovery:desc global_score". '
+        "Parses all description fields into a table instead of streaming. "
+        "By default sorts on the third field like the streaming sort (score, or global_score for natives).",
+    )
+    parser.add_argument("-d", "--dedup", action="store_true", help="Only keep the best ranked copy of each sequence.")
+    parser.add_argument("--save_table", type=Path, default=None, help="Save the parsed table (.npz) for later re-ranking.")
+    parser.add_argument("--load_table", type=Path, default=None, help="Rank a table saved with --save_table.")
+    parser.add_argument("-t", "--tmp_dir", type=Path, default=None, help="Folder for the sorted chunks (default: system temp).")
     args = parser.parse_args()
 
+    if not args.fasta_paths and args.load_table is None:
+        parser.error("Either fasta_paths or --load_table is required.")
+
+    if args.sort_by is not None or args.dedup or args.save_table is not None or args.load_table is not None:
+        if args.load_table is not None:
+            table = load_score_table(args.load_table)
+        else:
+            table = read_score_table(args.fasta_paths)
+        if args.save_table is not None:
+            save_score_table(table, args.save_table)
+
+        if args.sort_by is not None:
+            order = sort_order(table, args.sort_by)
+        else:
+            # Same key as the streaming sort, i.e. global_score for the native sequences.
+            order = np.argsort([get_score(el) for el in table.descriptions.tolist()], kind="stable")
+        if args.dedup:
+            order = dedup_order(table, order)
+        order = order[: args.top]
+        write_records(zip(table.descriptions[order].tolist(), table.sequences[order].tolist()), args.out_path)
+        return
 
-    sorted_scores = sort_scores(args.fasta_paths)
-    args.out_path.write_text("\n".join(flatten(sorted_scores)))
+    if args.top is not None:
+        sorted_scores = top_scores(args.fasta_paths, args.top)
+    else:
+        sorted_scores = external_sort_scores(args.fasta_paths, args.chunk_size, args.tmp_dir)
+    write_records(sorted_scores, args.out_path)
 
 
 if __name__ == "__main__":
@@ -1,76 +1,98 @@
 # Script to run ESMFold on the cluster.
 # author Holly Ford, h.ford@bristol.ac.uk
 
-import sys
+import os
 import torch
 import esm
+from fasta_reader import read_fasta
+from esmfold_resume import RunManifest, atomic_write, log_skipped, valid_pdb
+from esmfold_chunking import ChunkPolicy
+from esmfold_batching import infer_batches, prediction_scores
+from esmfold_cache import PredictionCache, fold_unique
+from esmfold_writer import OrderedWriterPool
+from esmfold_sharding import parse_shard, shard_dir, shard_records
 
 # You need to make a directory in your scratch space for torch hub to reside
 # In your scratch space, make a directory .cache/torch/hub
 # Paste the path to this directory into the command below
 torch.hub.set_dir("/path/to/your/scratch/.cache/torch/hub")
 
-def esmfold(fasta_file):
-    with open(fasta_file, "r") as seqs:
-        model = esm.pretrained.esmfold_v1()
-        model = model.eval().cuda()
+def esmfold(fasta_file, resume=False, cache_dir=None, cache_size_gb=50, writers=2, gpu_memory_gb=None, cpu_fallback=False, shard=None):
+    # with shard="i/N" only that task's share of the records is folded, and its outputs go to shard_{i}_of_{N}/
+    # (see esmfold_sharding.py, merge the folders afterwards)
+    fasta_records = read_fasta(fasta_file)
+    if shard is not None:
+        index, n_shards = parse_shard(shard)
+        fasta_records = shard_records(os.path.abspath(fasta_file), index, n_shards)
+        if cache_dir is not None:
+            cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(shard_dir(index, n_shards), exist_ok=True)
+        os.chdir(shard_dir(index, n_shards))
 
-        # Optionally, uncomment to set a chunk size for axial attention. This can help reduce memory.
-        # Lower sizes will have lower memory requirements at the cost of increased speed.
-        # model.set_chunk_size(128)
+    model = esm.pretrained.esmfold_v1()
+    model = model.eval().cuda()
 
+    # The chunk size for axial attention is set for every run (see esmfold_chunking.py). Lower sizes will have
+    # lower memory requirements at the cost of increased speed. With gpu_memory_gb, the largest size that fits
+    # the sequence length is picked, otherwise no chunking is used. Runs that run out of memory are retried
+    # with smaller chunks (and on the CPU with cpu_fallback) before the sequence is skipped.
+    policy = ChunkPolicy(gpu_memory_gb, None, cpu_fallback, free_memory=torch.cuda.empty_cache)
 
-        # reads a fasta file into an array
-        seqs_array = []
-        for element in seqs:
-            seqs_array.append(str(element))
+    # predictions are cached on the sequence and these settings, see esmfold_cache.py
+    cache = None
+    if cache_dir is not None:
+        cache = PredictionCache(cache_dir, {"model": "esmfold_v1", **policy.settings()}, int(cache_size_gb * 1024**3))
 
-        # appends sequences to a sequence array
-        clean_seq_array=[]
-        for i in range(len(seqs_array)):
-            if i % 2:
-                clean_seq_array.append(seqs_array[i])
+    # finished records are logged in the manifest, with resume they are skipped if their PDB is still valid
+    manifest = RunManifest()
 
-        # appends names to a names array
-        clean_name_array=[]
-        for i in range(len(seqs_array)):
-            if seqs_array[i] not in clean_seq_array:
-                clean_name_array.append(seqs_array[i])
+    #defines a function to infer the pdb files, with the scores as well when they are cached
+    def predict(unique_records, skip):
+        with torch.no_grad():
+            yield from infer_batches(model, unique_records, with_pdb=True, scores=cache is not None, policy=policy, on_skip=skip, lazy=True)
 
-        # tidies up the name array
-        clean_name_array_final=[]
-        for name in clean_name_array:
-            clean_name_array_final.append(name[1:-1])
+    #defines a function to write the pdb files of one prediction, run by the writer threads
+    def write_result(seq, names, output, cached):
+        # new predictions are converted to PDB here (see BatchOutput in esmfold_batching.py)
+        if not cached:
+            output = output()
+        if cache is not None and not cached:
+            cache.put(seq, prediction_scores(output))
+        for name in names:
+            atomic_write(f"{name}.pdb", output["pdb"])
+        return names
 
-        # tidies up the seq array - to remove hemes and anything else that follows the hemes
-        clean_seq_array_final=[]
-        for seq in clean_seq_array:
-            processed_seq = seq.split('X')[0]
-            clean_seq_array_final.append(processed_seq)
+    #defines a function to log the finished records, run in the main thread in the order they were folded
+    def finish_result(names):
+        for name in names:
+            manifest.add(name, pdb=f"{name}.pdb")
 
-        # Multimer prediction can be done with chains separated by ':'
+    #loops though the records, the fasta file is read lazily (see fasta_reader.py)
+    #records with the same sequence are only folded once, and cached sequences are not folded at all
+    records = ((name, seq) for name, seq in fasta_records
+               if not (resume and name in manifest and valid_pdb(f"{name}.pdb", len(seq.replace(':', '')))))
+    #the pdb files are written by background threads while the next sequences are folded
+    with OrderedWriterPool(write_result, finish_result, writers) as pool:
+        for seq, names, output, cached in fold_unique(records, predict, cache, need_pdb=True, on_skip=log_skipped):
+            pool.submit(seq, names, output, cached)
 
-        #defines a function to infer and write a pdb file
-        def infer_and_write_result(seq, model, output_file):
-            with torch.no_grad():
-                output = model.infer_pdb(seq)
-            with open(output_file, "w") as f:
-                f.write(output)
+    import biotite.structure.io as bsio
+    struct = bsio.load_structure("result.pdb", extra_fields=["b_factor"])
+    print(struct.b_factor.mean())  # this will be the pLDDT
+    # 88.3
+    pass
+if __name__ == "__main__":
+    import argparse
 
-        #loops though the arrays
-        for seq, name, in zip(clean_seq_array_final, clean_name_array_final):
-            output_file = f"{name}.pdb"
-            infer_and_write_result(seq, model, output_file)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fasta_file", help="Fasta file of the sequences to fold")
+    parser.add_argument("--resume", action="store_true", help="Skip records that already finished in an earlier run (see esmfold_manifest.jsonl)")
+    parser.add_argument("--cache_dir", default=None, help="Folder of cached predictions, can be shared between jobs (e.g. on scratch)")
+    parser.add_argument("--cache_size_gb", type=float, default=50, help="Size limit of the cache, the least recently used predictions are removed first")
+    parser.add_argument("--writers", type=int, default=2, help="Threads writing the outputs while the GPU folds the next sequences (0: write before folding the next one)")
+    parser.add_argument("--gpu_memory_gb", type=float, default=None, help="GPU memory budget used to pick the chunk size of each run (default: no chunking)")
+    parser.add_argument("--cpu_fallback", action="store_true", help="Fold sequences that run out of GPU memory at the smallest chunk size on the CPU (slow) instead of skipping them")
+    parser.add_argument("--shard", default=None, help="Fold only shard i of N, e.g. $SLURM_ARRAY_TASK_ID/4 (numbered from 0), into shard_{i}_of_{N}/")
+    args = parser.parse_args()
 
-        import biotite.structure.io as bsio
-        struct = bsio.load_structure("result.pdb", extra_fields=["b_factor"])
-        print(struct.b_factor.mean())  # this will be the pLDDT
-        # 88.3
-        pass
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python script.py <fasta_file>")
-        sys.exit(1)
-        
-    fasta_file = sys.argv[1]
-    esmfold(fasta_file)
+    esmfold(args.fasta_file, args.resume, args.cache_dir, args.cache_size_gb, args.writers, args.gpu_memory_gb, args.cpu_fallback, args.shard)
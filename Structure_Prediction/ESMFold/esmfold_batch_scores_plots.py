@@ -1,92 +1,128 @@
-import sys
+import os
 import torch
 import esm
+from fasta_reader import read_fasta
+from esmfold_batching import infer_batches, model_length, prediction_scores
+from esmfold_cache import PredictionCache, fold_unique
+from esmfold_writer import OrderedWriterPool
+from esmfold_sharding import parse_shard, shard_dir, shard_records
+from esmfold_resume import RunManifest, atomic_write, log_skipped, repair_report, valid_scores_json
+from esmfold_chunking import ChunkPolicy
 import json
-import numpy as np
 from scipy.special import softmax
 import re
 
 #Script Author ben.hardy@bristol.ac.uk
 
-def esmfold(fasta_file):
-    with open(fasta_file, "r") as seqs:
-        model = esm.pretrained.esmfold_v1()
-        model.cuda().requires_grad_(False)
-        #model = model.eval().cuda()
-
-        # Optionally, uncomment to set a chunk size for axial attention. This can help reduce memory.
-        # Lower sizes will have lower memory requirements at the cost of increased speed.
-        model.set_chunk_size(128)
-
-        # reads a fasta file into an array
-        seqs_array = []
-        for element in seqs:
-            seqs_array.append(str(element))
-
-        # appends sequences to a sequence array
-        clean_seq_array=[]
-        for i in range(len(seqs_array)):
-            if i % 2:
-                clean_seq_array.append(seqs_array[i])
-
-        # appends names to a names array
-        clean_name_array=[]
-        for i in range(len(seqs_array)):
-            if seqs_array[i] not in clean_seq_array:
-                clean_name_array.append(seqs_array[i])
-
-        # tidies up the name array
-        clean_name_array_final=[]
-        for name in clean_name_array:
-            clean_name_array_final.append(name[1:-1])
-
-        # tidies up the seq array - to remove hemes and anything else that follows the hemes
-        clean_seq_array_final=[]
-        for seq in clean_seq_array:
-            processed_seq = seq.split('X')[0]
-            clean_seq_array_final.append(processed_seq)
-
-        # Multimer prediction can be done with chains separated by ':'
-
-        #defines a function to infer and write a pdb file
-        def infer_and_write_result(seq, model, output_file, name):
-            with torch.no_grad():
-                output = model.infer(seq)
-            #with open(str(name) + ".pdb", "w") as f:
-            #    f.write(model.output_to_pdb(output)[0])
-
-            # extract only the sample name from the long name (.e.g Sample 1) as a short identifier
-            name=str(name)
-            pattern=r"__sample_(\d+)"
-            match = re.search(pattern,name)
-            if match:
-                sample_string=match.group(0)
-            else:
-                print("Pattern not found in the text.")
-
-            # convert ESM output to numpy array
-            output = {k: v.cpu().numpy() for k, v in output.items()}
-            ptm = output["ptm"][0]
-            plddt = output["plddt"][0,:,1].mean()
-            with open("pTM_pLDDT_report.dat", "a") as f:
-                f.write(f' name: {sample_string} ptm: {ptm:.3f} plddt: {plddt:.1f}' "\n")
-
-            # extract PAE and pLDDT values from the output
-            contact_probs = (output["aligned_confidence_probs"][0] * np.arange(64)).mean(-1) * 31
-            plddt_scores = output["plddt"][0,:,1]
-            # write PAE and pLDDT values to a json file to be plotted
-            with open("scores_" + str(sample_string) + ".json", "w") as f:
-                json.dump({"pae": contact_probs.tolist(), "plddt": plddt_scores.tolist()}, f)
-
-        #loops though the arrays
-        for seq, name, in zip(clean_seq_array_final, clean_name_array_final):
-            output_file = f"{name}.pdb"
-            infer_and_write_result(seq, model, output_file, name)
+REPORT = "pTM_pLDDT_report.dat"
+
+def sample_id(name):
+    # extract only the sample name from the long name (.e.g Sample 1) as a short identifier
+    # names that are already short, e.g. "{target}__sample_{n}" from build_esmfold_queue.py, are kept whole
+    # so that samples of different targets don't share a scores file
+    # names without a sample number are kept whole as well, so every record still gets its own scores file
+    name=str(name)
+    if re.fullmatch(r".+__sample_\d+", name):
+        return name
+    pattern=r"__sample_(\d+)"
+    match = re.search(pattern,name)
+    if match:
+        return match.group(0)
+    else:
+        return name
+
+CHUNK_SIZE = 128
+
+def esmfold(fasta_file, max_tokens=0, resume=False, cache_dir=None, cache_size_gb=50, writers=2, gpu_memory_gb=None, cpu_fallback=False, shard=None):
+    # with shard="i/N" only that task's share of the records is folded, and its outputs go to shard_{i}_of_{N}/
+    # (see esmfold_sharding.py, merge the folders afterwards)
+    fasta_records = read_fasta(fasta_file)
+    if shard is not None:
+        index, n_shards = parse_shard(shard)
+        fasta_records = shard_records(os.path.abspath(fasta_file), index, n_shards)
+        if cache_dir is not None:
+            cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(shard_dir(index, n_shards), exist_ok=True)
+        os.chdir(shard_dir(index, n_shards))
+
+    model = esm.pretrained.esmfold_v1()
+    model.cuda().requires_grad_(False)
+    #model = model.eval().cuda()
+
+    # The chunk size for axial attention is set for every run (see esmfold_chunking.py). Lower sizes will have
+    # lower memory requirements at the cost of increased speed. With gpu_memory_gb, the largest size that fits
+    # the sequence length is picked, otherwise CHUNK_SIZE is used. Runs that still run out of memory are retried
+    # with smaller chunks (and on the CPU with cpu_fallback) before the sequence is skipped.
+    policy = ChunkPolicy(gpu_memory_gb, CHUNK_SIZE, cpu_fallback, free_memory=torch.cuda.empty_cache)
+
+    # predictions are cached on the sequence and these settings, see esmfold_cache.py
+    cache = None
+    if cache_dir is not None:
+        cache = PredictionCache(cache_dir, {"model": "esmfold_v1", **policy.settings()}, int(cache_size_gb * 1024**3))
+
+    # finished records are logged in the manifest, with resume they are skipped if their scores file is still valid
+    manifest = RunManifest()
+    if resume:
+        repair_report(REPORT, [entry["row"] for entry in manifest.done.values() if "row" in entry])
+
+    def is_done(name, seq):
+        return resume and name in manifest and valid_scores_json(f"scores_{sample_id(name)}.json", model_length(seq))
+
+    #defines a function to write the scores of one prediction, run by the writer threads
+    def write_result(seq, names, output, cached):
+        # new predictions are converted here (copy to numpy, see BatchOutput in esmfold_batching.py)
+        # then extract PAE and pLDDT values from the output (see prediction_scores in esmfold_batching.py)
+        scores = output if cached else prediction_scores(output())
+        if cache is not None and not cached:
+            cache.put(seq, scores)
+        ptm = scores["ptm"]
+        plddt = scores["plddt"].mean()
+        contact_probs = scores["pae"]
+        plddt_scores = scores["plddt"]
+        # write PAE and pLDDT values to a json file to be plotted
+        scores_json = json.dumps({"pae": contact_probs.tolist(), "plddt": plddt_scores.tolist()})
+
+        rows = []
+        for name in names:
+            sample_string = sample_id(name)
+            atomic_write("scores_" + str(sample_string) + ".json", scores_json)
+            rows.append((name, f' name: {sample_string} ptm: {ptm:.3f} plddt: {plddt:.1f}'))
+        return rows
+
+    #defines a function to add the report rows, run in the main thread in the order the sequences were folded
+    def finish_result(rows):
+        # the record is only marked done once its scores file is complete, and before its report row is added
+        for name, row in rows:
+            manifest.add(name, row=row)
+            with open(REPORT, "a") as f:
+                f.write(row + "\n")
+
+    #loops though the records, the fasta file is read lazily (see fasta_reader.py)
+    #with max_tokens, sequences of similar length are run together in batches of up to max_tokens (n_seqs * length**2)
+    #records with the same sequence are only folded once, and cached sequences are not folded at all
+    records = ((name, seq) for name, seq in fasta_records if not is_done(name, seq))
+
+    def predict(unique_records, skip):
+        return infer_batches(model, unique_records, max_tokens, with_pdb=cache is not None, policy=policy, on_skip=skip, lazy=True)
+
+    #the outputs are written by background threads while the next sequences are folded
+    with torch.no_grad(), OrderedWriterPool(write_result, finish_result, writers) as pool:
+        for seq, names, output, cached in fold_unique(records, predict, cache, on_skip=log_skipped):
+            pool.submit(seq, names, output, cached)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python script.py <fasta_file>")
-        sys.exit(1)
-
-    fasta_file = sys.argv[1]
-    esmfold(fasta_file)
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fasta_file", help="Fasta file of the sequences to fold")
+    parser.add_argument("--max_tokens", type=int, default=0, help="Batch sequences up to n_seqs * length**2 <= max_tokens (0: one sequence at a time), e.g. 1000000 to batch 4 sequences of 500 residues")
+    parser.add_argument("--resume", action="store_true", help="Skip records that already finished in an earlier run (see esmfold_manifest.jsonl)")
+    parser.add_argument("--cache_dir", default=None, help="Folder of cached predictions, can be shared between jobs (e.g. on scratch)")
+    parser.add_argument("--cache_size_gb", type=float, default=50, help="Size limit of the cache, the least recently used predictions are removed first")
+    parser.add_argument("--writers", type=int, default=2, help="Threads writing the outputs while the GPU folds the next sequences (0: write before folding the next one)")
+    parser.add_argument("--gpu_memory_gb", type=float, default=None, help="GPU memory budget used to pick the chunk size of each run (default: always chunk size 128)")
+    parser.add_argument("--cpu_fallback", action="store_true", help="Fold sequences that run out of GPU memory at the smallest chunk size on the CPU (slow) instead of skipping them")
+    parser.add_argument("--shard", default=None, help="Fold only shard i of N, e.g. $SLURM_ARRAY_TASK_ID/4 (numbered from 0), into shard_{i}_of_{N}/")
+    args = parser.parse_args()
+
+    esmfold(args.fasta_file, args.max_tokens, args.resume, args.cache_dir, args.cache_size_gb, args.writers, args.gpu_memory_gb, args.cpu_fallback, args.shard)
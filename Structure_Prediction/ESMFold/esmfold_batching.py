@@ -0,0 +1,128 @@
+# Length-bucketed batching for ESMFold inference.
+# Only needs numpy, so the batching can be checked on CPU with a stub model that has an infer(list_of_seqs) method.
+import functools
+import threading
+import numpy as np
+
+# ESMFold joins the chains of a multimer ('A:B') with a 25 residue glycine linker
+CHAIN_LINKER_LENGTH = 25
+
+# outputs that are kept per sequence, everything else (e.g. the pair representation) stays on the GPU
+# the model computes "ptm" for every sequence on its own unpadded length, so it is valid in batched runs too
+OUTPUT_KEYS = ("ptm", "plddt", "aligned_confidence_probs")
+
+# L x L outputs that neither the scores nor output_to_pdb use, dropped as soon as a batch is folded
+# so batches waiting for a writer thread don't hold them in GPU memory
+UNUSED_PAIR_KEYS = ("s_z", "distogram_logits", "ptm_logits", "predicted_aligned_error")
+
+def model_length(seq, linker_length=CHAIN_LINKER_LENGTH):
+    # number of positions the model sees for a sequence, including the chain linkers
+    n_breaks = seq.count(':')
+    return len(seq) - n_breaks + n_breaks * linker_length
+
+def make_batches(records, max_tokens):
+    # packs (name, seq) records into batches, shortest sequences first
+    # every batch is padded to its longest sequence and the pair representation grows with length squared,
+    # so a batch costs n_seqs * longest**2, which is kept under max_tokens
+    # a sequence that is over the budget on its own is run by itself
+    records = sorted(records, key=lambda record: model_length(record[1]))
+    batch = []
+    for record in records:
+        length = model_length(record[1])
+        if batch and (len(batch) + 1) * length ** 2 > max_tokens:
+            yield batch
+            batch = []
+        batch.append(record)
+    if batch:
+        yield batch
+
+def split_outputs(output, seqs):
+    # splits a batched ESMFold output (numpy arrays) into one unpadded dict per sequence
+    results = []
+    for i, seq in enumerate(seqs):
+        length = model_length(seq)
+        results.append({
+            "ptm": output["ptm"][i],
+            "plddt": output["plddt"][i, :length],
+            "aligned_confidence_probs": output["aligned_confidence_probs"][i, :length, :length],
+        })
+    return results
+
+def prediction_scores(output):
+    # pTM, per-residue pLDDT and PAE of one split output, as written to the report and scores_*.json
+    scores = {
+        "ptm": output["ptm"],
+        "plddt": output["plddt"][:,1],
+        "pae": (output["aligned_confidence_probs"] * np.arange(64)).mean(-1) * 31,
+    }
+    if "pdb" in output:
+        scores["pdb"] = output["pdb"]
+    return scores
+
+def to_numpy(value):
+    return value.cpu().numpy() if hasattr(value, "cpu") else np.asarray(value)
+
+def _infer(model, batch, policy, on_skip):
+    # yields (batch, output) with the batch split into single sequences if it runs out of memory,
+    # sequences that don't fit at all are passed to on_skip(name, seq) and left out
+    seqs = [seq for _, seq in batch]
+    if policy is None:
+        yield batch, model.infer(seqs)
+        return
+    output = policy.infer(model, seqs, [model_length(seq) for seq in seqs])
+    if output is not None:
+        yield batch, output
+    elif len(batch) > 1:
+        for record in batch:
+            yield from _infer(model, [record], policy, on_skip)
+    elif on_skip is not None:
+        on_skip(*batch[0])
+
+class BatchOutput:
+    # the model output of one batch, converted (output_to_pdb, copy to numpy, split) on first use
+    # so with lazy infer_batches this runs in a writer thread, while the main thread folds the next batch
+    def __init__(self, model, output, seqs, with_pdb, scores):
+        drop = UNUSED_PAIR_KEYS if scores else UNUSED_PAIR_KEYS + ("aligned_confidence_probs",)
+        self.model = model
+        self.output = {k: v for k, v in output.items() if k not in drop}
+        self.seqs = seqs
+        self.with_pdb = with_pdb
+        self.scores = scores
+        self.results = None
+        # the sequences of a batch may be written by different threads, the batch is converted once
+        self.lock = threading.Lock()
+
+    def result(self, i):
+        with self.lock:
+            if self.results is None:
+                self.results = self._convert()
+                self.output = None
+        return self.results[i]
+
+    def _convert(self):
+        pdbs = self.model.output_to_pdb(self.output) if self.with_pdb else None
+        if self.scores:
+            output = {k: to_numpy(self.output[k]) for k in OUTPUT_KEYS if k in self.output}
+            results = split_outputs(output, self.seqs)
+        else:
+            results = [{} for _ in self.seqs]
+        if self.with_pdb:
+            for result, pdb in zip(results, pdbs):
+                result["pdb"] = pdb
+        return results
+
+def infer_batches(model, records, max_tokens=0, with_pdb=False, scores=True, policy=None, on_skip=None, lazy=False):
+    # yields (name, result) for every record, see split_outputs
+    # with max_tokens=0 every sequence is run on its own, in file order
+    # with_pdb adds the predicted structure as "pdb" (what model.infer_pdb returns), scores=False leaves out the rest
+    # policy (see esmfold_chunking.py) picks the chunk size of each run and handles out-of-memory errors
+    # with lazy, result is a function returning the result, so the conversion can run in a writer thread
+    batches = make_batches(records, max_tokens) if max_tokens else ([record] for record in records)
+    for batch in batches:
+        for batch, output in _infer(model, batch, policy, on_skip):
+            batch_output = BatchOutput(model, output, [seq for _, seq in batch], with_pdb, scores)
+            for i, (name, _) in enumerate(batch):
+                if lazy:
+                    yield name, functools.partial(batch_output.result, i)
+                else:
+                    yield name, batch_output.result(i)
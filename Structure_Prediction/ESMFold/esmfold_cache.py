@@ -0,0 +1,118 @@
+# On-disk cache of ESMFold predictions, keyed on the sequence and the model settings.
+# Reruns, shared controls and designs that converged to the same sequence are then only folded once,
+# and the cache can be shared between jobs (e.g. on scratch). Only needs numpy.
+import hashlib
+import itertools
+import json
+import os
+import threading
+import numpy as np
+
+class PredictionCache:
+    # one .npz per prediction holding the pTM, per-residue pLDDT, PAE and (if available) the PDB
+    # a hit touches the file, so the least recently used predictions are evicted first once max_bytes is reached
+    def __init__(self, cache_dir, settings, max_bytes=50 * 1024**3):
+        self.cache_dir = cache_dir
+        self.settings = settings
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        # put may be called from the writer threads
+        self.lock = threading.Lock()
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+        for folder in os.scandir(self.cache_dir):
+            if folder.is_dir():
+                yield from (entry for entry in os.scandir(folder.path) if entry.name.endswith(".npz"))
+
+    def key(self, seq):
+        # the model settings are part of the key, e.g. a different chunk size gives a separate entry
+        text = json.dumps({"seq": seq, **self.settings}, sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _path(self, seq):
+        key = self.key(seq)
+        return os.path.join(self.cache_dir, key[:2], key + ".npz")
+
+    def get(self, seq, need_pdb=False):
+        # returns the cached scores (see esmfold_batching.prediction_scores), or None
+        path = self._path(seq)
+        try:
+            with np.load(path) as data:
+                if need_pdb and "pdb" not in data.files:
+                    return None
+                result = {"ptm": data["ptm"][()], "plddt": data["plddt"], "pae": data["pae"]}
+                if "pdb" in data.files:
+                    result["pdb"] = str(data["pdb"])
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            # missing, or evicted/being replaced by another job
+            return None
+        return result
+
+    def put(self, seq, result):
+        path = self._path(seq)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **{k: np.asarray(v) for k, v in result.items()})
+        with self.lock:
+            self.size += os.path.getsize(tmp)
+            os.replace(tmp, path)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # removes the least recently used entries until the cache is back under 90% of max_bytes,
+        # the size is recounted from disk as other jobs may share the cache
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+
+def fold_unique(records, predict, cache=None, need_pdb=False, on_skip=None, window=1000):
+    # collapses records with the same sequence, looks each sequence up in the cache and only predicts the misses
+    # records are (name, seq), predict takes (seq, seq) records and a skip callback and yields (seq, output)
+    # like infer_batches, sequences passed to skip are reported as on_skip(names, seq)
+    # yields (seq, names, result, cached) once per unique sequence, cache hits first
+    # (for a prediction, result is whatever predict yielded, e.g. a function with lazy infer_batches)
+    # new predictions are not stored here, call cache.put(seq, scores) once the output is processed
+    # records are read window at a time, so folding starts straight away on a lazily read fasta file
+    # repeats in a later window are found in the cache, or folded again without one
+    records = iter(records)
+    while True:
+        groups = {}
+        for name, seq in itertools.islice(records, window):
+            groups.setdefault(seq, []).append(name)
+        if not groups:
+            return
+        yield from _fold_window(groups, predict, cache, need_pdb, on_skip)
+
+def _fold_window(groups, predict, cache, need_pdb, on_skip):
+    misses = []
+    for seq, names in groups.items():
+        result = cache.get(seq, need_pdb) if cache is not None else None
+        if result is None:
+            misses.append((seq, seq))
+        else:
+            yield seq, names, result, True
+
+    def skip(seq, _):
+        if on_skip is not None:
+            on_skip(groups[seq], seq)
+
+    for seq, result in predict(misses, skip):
+        yield seq, groups[seq], result, False
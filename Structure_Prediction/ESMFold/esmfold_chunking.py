@@ -0,0 +1,148 @@
+# Picks the axial-attention chunk size for every ESMFold run and retries out-of-memory failures,
+# so one long sequence doesn't kill the whole job. Doesn't need torch, so it can be checked with a stub model.
+
+# chunk sizes tried, largest first (None: no chunking, fastest but needs the most memory)
+CHUNK_SIZES = (None, 512, 256, 128, 64, 32, 16)
+
+# rough memory estimate per position pair: the pair representation (128 channels, float32, a few live copies)
+# plus the attention scores of one chunk of rows (4 heads, float32, a few live copies)
+PAIR_BYTES = 128 * 4 * 8
+ATTENTION_BYTES = 4 * 4 * 4
+
+def is_oom(error):
+    # torch.cuda.OutOfMemoryError is a RuntimeError saying "CUDA out of memory"
+    return isinstance(error, MemoryError) or (isinstance(error, RuntimeError) and "out of memory" in str(error).lower())
+
+def estimate_bytes(length, chunk_size, n_seqs=1):
+    rows = length if chunk_size is None else min(chunk_size, length)
+    return n_seqs * length ** 2 * (PAIR_BYTES + rows * ATTENTION_BYTES)
+
+class ChunkPolicy:
+    # memory_gb: GPU memory budget, the largest chunk size estimated to fit is used for each run
+    #            without a budget, default_chunk_size is tried first
+    # on an out-of-memory error the run is retried with the next smaller chunk size, a batch is split into
+    # single sequences first, and with allow_cpu a single sequence is tried on the CPU before it is given up
+    # (slow: the whole model is moved to the CPU and back for that sequence)
+    def __init__(self, memory_gb=None, default_chunk_size=None, allow_cpu=False, free_memory=None, log=print):
+        self.memory_gb = memory_gb
+        self.default_chunk_size = default_chunk_size
+        self.allow_cpu = allow_cpu
+        # e.g. torch.cuda.empty_cache, called after every out-of-memory error
+        self.free_memory = free_memory
+        self.log = log
+        # smallest n_seqs * length**2 that ran out of memory for each chunk size, so later runs that are
+        # at least as big start at a smaller chunk size straight away
+        self.failed = {}
+
+    def settings(self):
+        # part of the prediction cache key
+        return {"chunk_size": self.default_chunk_size, "gpu_memory_gb": self.memory_gb}
+
+    def chunk_size(self, length, n_seqs=1):
+        if self.memory_gb is None:
+            return self.default_chunk_size
+        for chunk_size in CHUNK_SIZES:
+            if estimate_bytes(length, chunk_size, n_seqs) <= self.memory_gb * 1024**3:
+                return chunk_size
+        return CHUNK_SIZES[-1]
+
+    def candidates(self, chunk_size):
+        # chunk_size followed by the smaller ones to fall back to
+        return [chunk_size] + [el for el in CHUNK_SIZES[1:] if chunk_size is None or el < chunk_size]
+
+    def _handle_oom(self, error, what):
+        if not is_oom(error):
+            raise error
+        self.log(f"Out of memory {what}")
+        if self.free_memory is not None:
+            self.free_memory()
+
+    def infer(self, model, seqs, lengths):
+        # returns the model output, or None if it doesn't fit (for a batch: split it and try again)
+        cost = len(seqs) * max(lengths) ** 2
+        for chunk_size in self.candidates(self.chunk_size(max(lengths), len(seqs))):
+            if chunk_size in self.failed and cost >= self.failed[chunk_size]:
+                continue
+            model.set_chunk_size(chunk_size)
+            try:
+                return model.infer(seqs)
+            except Exception as error:
+                self._handle_oom(error, f"for {len(seqs)} sequence(s) of up to {max(lengths)} residues with chunk size {chunk_size}")
+            self.failed[chunk_size] = min(cost, self.failed.get(chunk_size, cost))
+            if len(seqs) > 1:
+                return None
+
+        if len(seqs) > 1 or not self.allow_cpu:
+            return None
+        # last try on the CPU (slow), with the chunk size the budget would pick as CPU memory is usually larger
+        # ESMFold keeps its ESM-2 trunk in fp16, which the CPU can't run, so the CPU run is in float32
+        # any error skips the sequence, not only out of memory
+        esm = getattr(model, "esm", None)
+        model.cpu().float()
+        try:
+            model.set_chunk_size(self.chunk_size(max(lengths)))
+            return model.infer(seqs)
+        except Exception as error:
+            self.log(f"Failed on the CPU for a sequence of {max(lengths)} residues: {error}")
+            return None
+        finally:
+            model.cuda()
+            if esm is not None:
+                esm.half()
+
+if __name__ == "__main__":
+    # checks the out-of-memory handling with a stub model that runs out of GPU memory above a size, no torch needed
+    from esmfold_batching import infer_batches
+
+    class StubModel:
+        def __init__(self, gpu_bytes):
+            self.gpu_bytes = gpu_bytes
+            self.device = "cuda"
+            self.chunk_size = None
+            self.runs = []
+
+        def set_chunk_size(self, chunk_size):
+            self.chunk_size = chunk_size
+
+        def cpu(self):
+            self.device = "cpu"
+            return self
+
+        def cuda(self):
+            self.device = "cuda"
+            return self
+
+        def float(self):
+            return self
+
+        def infer(self, seqs):
+            self.runs.append((len(seqs), max(len(seq) for seq in seqs), self.chunk_size, self.device))
+            if self.device == "cuda" and estimate_bytes(max(len(seq) for seq in seqs), self.chunk_size, len(seqs)) > self.gpu_bytes:
+                raise RuntimeError("CUDA out of memory. Tried to allocate ...")
+            return {"device": self.device}
+
+    def fold(lengths, max_tokens=0, allow_cpu=False):
+        model = StubModel(1024**3)
+        skipped = []
+        records = [(f"seq_{i}", "A" * length) for i, length in enumerate(lengths)]
+        policy = ChunkPolicy(allow_cpu=allow_cpu, log=lambda message: None)
+        folded = [name for name, _ in infer_batches(model, records, max_tokens, scores=False, policy=policy,
+                                                    on_skip=lambda name, seq: skipped.append(name))]
+        return folded, skipped, model.runs, policy
+
+    # fits unchunked
+    folded, skipped, runs, _ = fold([100])
+    assert folded == ["seq_0"] and runs == [(1, 100, None, "cuda")]
+    # retried with smaller chunks until it fits, later runs as big start at the chunk size that worked
+    folded, skipped, runs, policy = fold([300, 300])
+    assert folded == ["seq_0", "seq_1"] and [run[2] for run in runs] == [None, 512, 256, 128, 64, 64]
+    assert policy.failed[128] == 300 ** 2
+    # a batch that doesn't fit is split into single sequences
+    folded, skipped, runs, _ = fold([250, 250], max_tokens=10**6)
+    assert folded == ["seq_0", "seq_1"] and runs[0][0] == 2 and all(run[0] == 1 for run in runs[1:])
+    # too big at every chunk size: skipped, or folded on the CPU with allow_cpu
+    folded, skipped, runs, _ = fold([600, 100])
+    assert folded == ["seq_1"] and skipped == ["seq_0"] and all(run[3] == "cuda" for run in runs)
+    folded, skipped, runs, _ = fold([600], allow_cpu=True)
+    assert folded == ["seq_0"] and not skipped and runs[-1][3] == "cpu"
+    print("ok")
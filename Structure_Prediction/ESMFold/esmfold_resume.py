@@ -0,0 +1,85 @@
+# Resume support for the ESMFold scripts, so a job that hit its time limit can be resubmitted unchanged.
+# Every finished record is logged in a manifest, and with --resume records that are in the manifest
+# and whose output file is still valid are skipped.
+import json
+import os
+import threading
+
+MANIFEST = "esmfold_manifest.jsonl"
+
+def atomic_write(path, text):
+    # writes to a temporary file first, so a crash never leaves a half written output behind
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class RunManifest:
+    # completed records, one json line each, appended and fsynced as soon as the record's outputs are written
+    # a line cut off by a crash is dropped when the manifest is read back
+    def __init__(self, path=MANIFEST):
+        self.path = path
+        self.done = {}
+        if not os.path.isfile(path):
+            return
+        with open(path, "r") as f:
+            text = f.read()
+        torn = False
+        for line in text.splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                torn = True
+                continue
+            self.done[entry["name"]] = entry
+        if torn or (text and not text.endswith("\n")):
+            atomic_write(path, "".join(json.dumps(entry) + "\n" for entry in self.done.values()))
+
+    def __contains__(self, name):
+        return name in self.done
+
+    def add(self, name, **fields):
+        entry = {"name": name, **fields}
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done[name] = entry
+
+def valid_scores_json(path, length):
+    # a scores_*.json is complete if it parses and has a pLDDT and a PAE row for every position
+    try:
+        with open(path, "r") as f:
+            scores = json.load(f)
+        return len(scores["plddt"]) == length and len(scores["pae"]) == length
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+def valid_pdb(path, n_residues):
+    # a PDB is complete if it ends with END and has a CA atom for every residue
+    try:
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return False
+    n_ca = sum(1 for line in lines if line.startswith("ATOM") and line[12:16] == " CA ")
+    return bool(lines) and lines[-1].startswith("END") and n_ca == n_residues
+
+def log_skipped(names, seq, path="esmfold_skipped.dat"):
+    # sequences that could not be folded at all (e.g. out of memory on GPU and CPU), they are retried on resume
+    for name in names:
+        print(f"Skipped {name} ({len(seq)} residues)")
+    with open(path, "a") as f:
+        f.writelines(f" name: {name} length: {len(seq)}\n" for name in names)
+
+def repair_report(report_path, rows):
+    # removes repeated lines from the report and adds the rows of finished records that are missing
+    # (e.g. the job stopped between logging a record and writing its row), so every row is there once
+    lines = []
+    if os.path.isfile(report_path):
+        with open(report_path, "r") as f:
+            lines = [line for line in f.read().splitlines() if line]
+    lines = list(dict.fromkeys(lines + rows))
+    atomic_write(report_path, "".join(line + "\n" for line in lines))
@@ -0,0 +1,104 @@
+# Splits one fasta file over the tasks of a SLURM job array without pre-splitting it, and merges the results.
+# Every task reads the sequence lengths, and records are dealt out so each shard gets about the same
+# total cost (length**2, as for the pair representation). Every task computes the same assignment.
+#
+# run task i of N (e.g. #SBATCH --array=0-3 and --shard $SLURM_ARRAY_TASK_ID/4), outputs go to shard_{i}_of_{N}/
+# then merge: python esmfold_sharding.py shard_*_of_4 --out_dir merged
+import heapq
+import os
+import re
+import shutil
+from fasta_reader import read_fasta
+from esmfold_batching import model_length
+
+def parse_shard(shard):
+    # "i/N" -> (i, N), shards are numbered from 0
+    try:
+        index, n_shards = (int(el) for el in shard.split("/"))
+    except ValueError:
+        raise ValueError(f'--shard should look like "i/N", got "{shard}"')
+    if not 0 <= index < n_shards:
+        raise ValueError(f"shard index {index} is not in 0..{n_shards - 1}")
+    return index, n_shards
+
+def shard_dir(index, n_shards):
+    return f"shard_{index}_of_{n_shards}"
+
+def parse_shard_dir(folder):
+    # "path/shard_{i}_of_{N}" -> (i, N), or None for other folders
+    match = re.fullmatch(r"shard_(\d+)_of_(\d+)", os.path.basename(os.path.normpath(folder)))
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def assign_shards(lengths, n_shards):
+    # longest first, each record goes to the shard with the lowest total cost so far
+    # ties go to the earlier record and the lower shard, so the result only depends on the lengths
+    order = sorted(range(len(lengths)), key=lambda i: (-lengths[i], i))
+    loads = [(0, shard) for shard in range(n_shards)]
+    assignment = [0] * len(lengths)
+    for i in order:
+        load, shard = heapq.heappop(loads)
+        assignment[i] = shard
+        heapq.heappush(loads, (load + lengths[i] ** 2, shard))
+    return assignment
+
+def shard_records(fasta_file, index, n_shards):
+    # yields the (name, seq) records of one shard, in file order, reading the fasta file twice
+    lengths = [model_length(seq) for _, seq in read_fasta(fasta_file)]
+    assignment = assign_shards(lengths, n_shards)
+    for shard, record in zip(assignment, read_fasta(fasta_file)):
+        if shard == index:
+            yield record
+
+def merge_shards(shard_dirs, out_dir, move=False):
+    # combines the reports, manifests, skipped lists and the scores_*.json / .pdb files of the shards
+    # repeated report rows are dropped (e.g. a shard that was resumed), rows keep the shard order
+    from esmfold_resume import MANIFEST, RunManifest, repair_report
+
+    os.makedirs(out_dir, exist_ok=True)
+    transfer = shutil.move if move else shutil.copy2
+    rows, manifest_entries, skipped = [], {}, []
+    n_files = 0
+    for folder in shard_dirs:
+        for file_name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, file_name)
+            if (file_name.startswith("scores_") and file_name.endswith(".json")) or file_name.endswith(".pdb"):
+                transfer(path, os.path.join(out_dir, file_name))
+                n_files += 1
+        report = os.path.join(folder, "pTM_pLDDT_report.dat")
+        if os.path.isfile(report):
+            with open(report, "r") as f:
+                rows.extend(line.rstrip("\n") for line in f if line.strip())
+        manifest_entries.update(RunManifest(os.path.join(folder, MANIFEST)).done)
+        skipped_path = os.path.join(folder, "esmfold_skipped.dat")
+        if os.path.isfile(skipped_path):
+            with open(skipped_path, "r") as f:
+                skipped.extend(line.rstrip("\n") for line in f if line.strip())
+
+    repair_report(os.path.join(out_dir, "pTM_pLDDT_report.dat"), rows)
+    manifest = RunManifest(os.path.join(out_dir, MANIFEST))
+    for name, entry in manifest_entries.items():
+        if name not in manifest:
+            manifest.add(**entry)
+    if skipped:
+        with open(os.path.join(out_dir, "esmfold_skipped.dat"), "a") as f:
+            f.writelines(line + "\n" for line in dict.fromkeys(skipped))
+    print(f"Merged {len(shard_dirs)} shards: {len(dict.fromkeys(rows))} report rows, {n_files} files, {len(set(skipped))} skipped")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Merge the shard_{i}_of_{N} folders of a sharded ESMFold run")
+    parser.add_argument("shard_dirs", nargs="+", help="Shard folders, e.g. shard_*_of_4")
+    parser.add_argument("--out_dir", default=".", help="Folder for the merged report and files")
+    parser.add_argument("--move", action="store_true", help="Move the scores/pdb files instead of copying them")
+    args = parser.parse_args()
+
+    # warn about shards that are missing, e.g. an array task that never ran
+    shards = {parse_shard_dir(folder) for folder in args.shard_dirs} - {None}
+    for n_shards in {n for _, n in shards}:
+        missing = [i for i in range(n_shards) if (i, n_shards) not in shards]
+        if missing:
+            print(f"Missing shards of {n_shards}: {missing}")
+
+    shard_dirs = sorted(args.shard_dirs, key=lambda folder: parse_shard_dir(folder) or (0, 0))
+    merge_shards(shard_dirs, args.out_dir, args.move)
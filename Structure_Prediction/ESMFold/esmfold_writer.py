@@ -0,0 +1,42 @@
+# Background writing for the ESMFold scripts, so the GPU can fold the next sequence while the previous
+# outputs are post-processed and written (e.g. the json of an L x L PAE matrix).
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+class OrderedWriterPool:
+    # process(*args) runs in one of the worker threads, finish(result) runs in the calling thread in submission order
+    # (so e.g. report rows are appended in the same order as without the pool)
+    # at most max_pending results are held in memory, submit blocks until the oldest one is finished
+    # with workers=0 everything runs straight away in the calling thread
+    def __init__(self, process, finish, workers=2, max_pending=None):
+        self.process = process
+        self.finish = finish
+        self.executor = ThreadPoolExecutor(workers) if workers > 0 else None
+        self.max_pending = max_pending or 2 * workers
+        self.pending = collections.deque()
+
+    def submit(self, *args):
+        if self.executor is None:
+            self.finish(self.process(*args))
+            return
+        while len(self.pending) >= self.max_pending:
+            self.finish(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(self.process, *args))
+        while self.pending and self.pending[0].done():
+            self.finish(self.pending.popleft().result())
+
+    def close(self):
+        # waits for and finishes everything still pending
+        try:
+            while self.pending:
+                self.finish(self.pending.popleft().result())
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # results that were already folded are still written if the loop stops with an error
+        self.close()
@@ -0,0 +1,30 @@
+# Shared FASTA reader for the ESMFold scripts.
+
+def clean_sequence(seq, truncate_at='X'):
+    # removes hemes and anything else that follows the hemes
+    if truncate_at:
+        seq = seq.split(truncate_at)[0]
+    return seq
+
+def read_fasta(fasta_file, truncate_at='X'):
+    # yields (name, sequence) one record at a time, so the file is never held in memory
+    # sequences may be wrapped over several lines, blank lines are skipped
+    # multimer prediction can be done with chains separated by ':'
+    name = None
+    seq_lines = []
+    with open(fasta_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, clean_sequence(''.join(seq_lines), truncate_at)
+                name = line[1:]
+                seq_lines = []
+            elif name is None:
+                raise ValueError(f"{fasta_file} does not start with a '>' header line")
+            else:
+                seq_lines.append(line)
+    if name is not None:
+        yield name, clean_sequence(''.join(seq_lines), truncate_at)